@@ -7,25 +7,90 @@ import uuid
 import io
 import sys
 import shutil
-import psutil
 import platform
 import aiohttp
 import random
-import yt_dlp
 import ast
+import importlib
+import json
 import traceback
+import threading
+import fcntl
+import hashlib
+import subprocess
+import contextlib
+import math
+import heapq
+import copy
 from pathlib import Path
 from dataclasses import dataclass
 from typing import Optional, Union
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 from functools import wraps
 from html import escape
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from queue import SimpleQueue
 from dotenv import load_dotenv
 
+# ==================== STARTUP PROFILING ====================
+class Profiler:
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.phases = []
+        self.imports = {}
+
+    def phase(self, name: str) -> None:
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def warm(self, modules: list) -> None:
+        for module in modules:
+            module.load()
+
+    def report(self) -> str:
+        lines = [f"Startup profile ({self.last - self.start:.2f}s to online):"]
+        lines += [f"  {name:<24}{seconds:>8.3f}s" for name, seconds in self.phases]
+        lines.append("Deferred imports:")
+        lines += [f"  {name:<24}{seconds:>8.3f}s" for name, seconds in self.imports.items()]
+        return "\n".join(lines)
+
+class LazyModule:
+    def __init__(self, name: str):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            start = time.perf_counter()
+            self.module = importlib.import_module(self.name)
+            profiler.imports[self.name] = time.perf_counter() - start
+        return self.module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+profiler = Profiler()
+
 # Third-party imports
-from pyrogram import Client, filters, enums, types, idle
-from pyrogram.errors import ChatAdminRequired, UserNotParticipant, FloodWait, MessageIdInvalid
+from pyrogram import Client, filters, enums, types, idle, StopPropagation
+from pyrogram.handlers import MessageHandler, CallbackQueryHandler
+from pyrogram.errors import (
+    ChatAdminRequired,
+    UserNotParticipant,
+    FloodWait,
+    MessageIdInvalid,
+    MediaEmpty,
+    FileReferenceExpired,
+    UserIsBlocked,
+    InputUserDeactivated,
+    ChatWriteForbidden,
+    QueryIdInvalid,
+    RPCError,
+    UserAlreadyParticipant,
+    InviteRequestSent,
+)
+profiler.phase("import pyrogram")
 from ntgcalls import ConnectionNotFound, TelegramServerError
 from pytgcalls import PyTgCalls, exceptions
 from pytgcalls.types import (
@@ -39,11 +104,27 @@ from pytgcalls.types import (
     StreamAudioEnded,
     StreamVideoEnded,
     Update,
-    GroupCallConfig
+    GroupCallConfig,
+    StreamEnded,
+    ChatUpdate,
+    UpdatedGroupCallParticipant,
+    GroupCallParticipant,
 )
-from pymongo import AsyncMongoClient
-from youtube_search import YoutubeSearch
-from PIL import Image, ImageDraw, ImageEnhance, ImageFilter, ImageFont, ImageOps
+profiler.phase("import pytgcalls")
+from pymongo import AsyncMongoClient, UpdateOne
+profiler.phase("import pymongo")
+
+# Heavy subsystems: imported on first use, or warmed in the background once the bot is online.
+psutil = LazyModule("psutil")
+yt_dlp = LazyModule("yt_dlp")
+youtube_search = LazyModule("youtube_search")
+youtubesearchpython = LazyModule("youtubesearchpython")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+ImageEnhance = LazyModule("PIL.ImageEnhance")
+ImageFilter = LazyModule("PIL.ImageFilter")
+ImageFont = LazyModule("PIL.ImageFont")
+ImageOps = LazyModule("PIL.ImageOps")
 
 load_dotenv()
 
@@ -65,8 +146,54 @@ class Config:
         self.SUPPORT_CHANNEL = os.getenv("SUPPORT_CHANNEL", "https://t.me/FallenAssociation")
         self.SUPPORT_CHAT = os.getenv("SUPPORT_CHAT", "https://t.me/DevilsHeavenMF")
         self.AUTO_END = os.getenv("AUTO_END", "False").lower() == "true"
+        self.AUTO_END_TIME = int(os.getenv("AUTO_END_TIME", 120))
         self.AUTO_LEAVE = os.getenv("AUTO_LEAVE", "False").lower() == "true"
+        self.AUTO_LEAVE_TIME = int(os.getenv("AUTO_LEAVE_TIME", 60)) * 60
+        self.AUTO_LEAVE_BATCH = int(os.getenv("AUTO_LEAVE_BATCH", 10))
         self.VIDEO_PLAY = os.getenv("VIDEO_PLAY", "True").lower() == "true"
+        self.DOWNLOAD_LIMIT = int(os.getenv("DOWNLOAD_LIMIT", 3))
+        self.MAX_TRANSMISSIONS = int(os.getenv("MAX_TRANSMISSIONS", 7))
+        self.MAX_CALLS = int(os.getenv("MAX_CALLS", 0))
+        self.MAX_ASSISTANT_CALLS = int(os.getenv("MAX_ASSISTANT_CALLS", 0))
+        self.VIDEO_WEIGHT = int(os.getenv("VIDEO_WEIGHT", 3))
+        self.PRE_TRANSCODE = os.getenv("PRE_TRANSCODE", "False").lower() == "true"
+        self.TRANSCODE_LIMIT = int(os.getenv("TRANSCODE_LIMIT", 2048)) * 1024 * 1024
+        self.TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", 1))
+        self.NORMALIZE = os.getenv("NORMALIZE", "False").lower() == "true"
+        self.LOUDNESS_TARGET = float(os.getenv("LOUDNESS_TARGET", -14))
+        self.CPU_LOW = int(os.getenv("CPU_LOW", 50))
+        self.CPU_HIGH = int(os.getenv("CPU_HIGH", 80))
+        self.SHARD_ROLE = os.getenv("SHARD_ROLE", "").lower()
+        self.SHARD_ID = int(os.getenv("SHARD_ID", 0))
+        self.SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", 1))
+        self.SHARD_SPAWN = os.getenv("SHARD_SPAWN", "False").lower() == "true"
+        self.UVLOOP = os.getenv("UVLOOP", "False").lower() == "true"
+        self.LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "True").lower() == "true"
+        self.LAG_THRESHOLD = int(os.getenv("LAG_THRESHOLD", 250))
+        self.COOKIES_REFRESH = int(os.getenv("COOKIES_REFRESH", 360)) * 60
+        self.MEDIA_STORE = os.getenv("MEDIA_STORE", "")
+        self.BROADCAST_RATE = int(os.getenv("BROADCAST_RATE", 20))
+        self.LOG_DIGEST_INTERVAL = int(os.getenv("LOG_DIGEST_INTERVAL", 300))
+        self.LOG_DIGEST_SIZE = int(os.getenv("LOG_DIGEST_SIZE", 50))
+        self.SEARCH_THRESHOLD = float(os.getenv("SEARCH_THRESHOLD", 0.75))
+        self.PROFILE_STARTUP = os.getenv("PROFILE_STARTUP", "False").lower() == "true"
+        self.POPULAR_TRACKS = int(os.getenv("POPULAR_TRACKS", 50))
+        self.POPULAR_HALF_LIFE = float(os.getenv("POPULAR_HALF_LIFE", 72)) * 3600
+        self.CACHE_LIMIT = int(os.getenv("CACHE_LIMIT", 0)) * 1024 * 1024
+        self.RATE_USER = int(os.getenv("RATE_USER", 5))
+        self.RATE_CHAT = int(os.getenv("RATE_CHAT", 20))
+        self.RATE_GLOBAL = int(os.getenv("RATE_GLOBAL", 120))
+        self.RATE_WINDOW = int(os.getenv("RATE_WINDOW", 60))
+        self.INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", 8))
+        self.INLINE_DEBOUNCE = int(os.getenv("INLINE_DEBOUNCE", 600)) / 1000
+        self.INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 300))
+        self.EXTRACTOR_POOL = int(os.getenv("EXTRACTOR_POOL", 2))
+        self.SEARCH_BACKENDS = os.getenv("SEARCH_BACKENDS", "youtube_search youtubesearchpython ytdlp").split()
+        self.SEARCH_HEDGE = int(os.getenv("SEARCH_HEDGE", 90))
+        self.SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID", "")
+        self.SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET", "")
+        self.SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1").rstrip("/")
+        self.SPOTIFY_AUTH_URL = os.getenv("SPOTIFY_AUTH_URL", "https://accounts.spotify.com/api/token")
         self.COOKIES_URL = [url for url in os.getenv("COOKIES_URL", "").split() if url and "batbin.me" in url]
         self.DEFAULT_THUMB = os.getenv("DEFAULT_THUMB", "https://te.legra.ph/file/3e40a408286d4eda24191.jpg")
         self.PING_IMG = os.getenv("PING_IMG", "https://files.catbox.moe/haagg2.png")
@@ -76,20 +203,43 @@ class Config:
         missing = [var for var in ["API_ID", "API_HASH", "BOT_TOKEN", "MONGO_URL", "LOGGER_ID", "OWNER_ID"] if not getattr(self, var)]
         if missing:
             raise SystemExit(f"Missing environment variables: {', '.join(missing)}")
+        if self.SHARD_ROLE not in ("", "front", "worker"):
+            raise SystemExit("SHARD_ROLE must be empty, 'front' or 'worker'.")
+        if self.SHARD_ROLE == "worker" and not 0 <= self.SHARD_ID < self.SHARD_WORKERS:
+            raise SystemExit(f"SHARD_ID must be between 0 and {self.SHARD_WORKERS - 1}.")
+        sessions = len([s for s in (self.SESSION1, self.SESSION2, self.SESSION3) if s])
+        if self.SHARD_ROLE and self.SHARD_WORKERS > sessions:
+            raise SystemExit(f"SHARD_WORKERS cannot exceed the number of assistant sessions ({sessions}).")
 
 config = Config()
 config.check()
 
 # ==================== LOGGING ====================
+class TelegramLogHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.loop = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # Only our own errors: pyrogram failures while sending would otherwise feed back into here.
+        if self.loop and record.name == __name__:
+            asyncio.run_coroutine_threadsafe(utils.error_log(record.getMessage()), self.loop)
+
+# File and console writes happen on the listener thread, never on the event loop.
+log_listener = QueueListener(
+    SimpleQueue(),
+    RotatingFileHandler("log.txt", maxBytes=10485760, backupCount=5),
+    logging.StreamHandler(),
+    error_handler := TelegramLogHandler(),
+    respect_handler_level=True,
+)
 logging.basicConfig(
     format="[%(asctime)s - %(levelname)s] - %(name)s: %(message)s",
     datefmt="%d-%b-%y %H:%M:%S",
-    handlers=[
-        RotatingFileHandler("log.txt", maxBytes=10485760, backupCount=5),
-        logging.StreamHandler(),
-    ],
+    handlers=[QueueHandler(log_listener.queue)],
     level=logging.INFO,
 )
+log_listener.start()
 logging.getLogger("httpx").setLevel(logging.ERROR)
 logging.getLogger("ntgcalls").setLevel(logging.CRITICAL)
 logging.getLogger("pymongo").setLevel(logging.ERROR)
@@ -130,13 +280,15 @@ class Track:
 # ==================== CORE COMPONENTS ====================
 class Bot(Client):
     def __init__(self):
+        worker = config.SHARD_ROLE == "worker"
         super().__init__(
-            name="Anony",
+            name=f"AnonyW{config.SHARD_ID}" if worker else "Anony",
             api_id=config.API_ID,
             api_hash=config.API_HASH,
             bot_token=config.BOT_TOKEN,
             parse_mode=enums.ParseMode.HTML,
-            max_concurrent_transmissions=7,
+            max_concurrent_transmissions=config.MAX_TRANSMISSIONS,
+            no_updates=worker,
         )
         self.owner = config.OWNER_ID
         self.logger = config.LOGGER_ID
@@ -167,6 +319,7 @@ class Bot(Client):
 class Userbot(Client):
     def __init__(self):
         self.clients = []
+        self.assistants = {}
         clients = {"one": "SESSION1", "two": "SESSION2", "three": "SESSION3"}
         for key, string_key in clients.items():
             name = f"AnonyUB{key[-1]}"
@@ -187,15 +340,17 @@ class Userbot(Client):
         client.name = client.me.first_name
         client.username = client.me.username
         client.mention = client.me.mention
+        client.num = num
         self.clients.append(client)
+        self.assistants[num] = client
         logger.info(f"Assistant {num} started as @{client.username}")
 
     async def boot(self):
-        if config.SESSION1:
+        if config.SESSION1 and shard.owns(1):
             await self.boot_client(1, self.one)
-        if config.SESSION2:
+        if config.SESSION2 and shard.owns(2):
             await self.boot_client(2, self.two)
-        if config.SESSION3:
+        if config.SESSION3 and shard.owns(3):
             await self.boot_client(3, self.three)
 
     async def exit(self):
@@ -215,6 +370,8 @@ class MongoDB:
         self.cmd_delete = []
         self.notified = []
         self.cache = self.db.cache
+        self.files = {}
+        self.filesdb = self.db.files
         self.logger = False
         self.assistant = {}
         self.assistantdb = self.db.assistant
@@ -226,6 +383,12 @@ class MongoDB:
         self.langdb = self.db.lang
         self.users = []
         self.usersdb = self.db.users
+        self.tracksdb = self.db.tracks
+        self.popularitydb = self.db.popularity
+        self.spotifydb = self.db.spotify
+        self.shardsdb = self.db.shard_updates
+        self.nodesdb = self.db.shard_nodes
+        self.pinsdb = self.db.shard_pins
 
     async def connect(self):
         try:
@@ -244,10 +407,13 @@ class MongoDB:
         return chat_id in self.active_calls
 
     async def add_call(self, chat_id: int) -> None:
+        if chat_id not in self.active_calls and shard.role == "worker":
+            await self.pinsdb.update_one({"_id": chat_id}, {"$set": {"worker": shard.id}}, upsert=True)
         self.active_calls[chat_id] = 1
 
     async def remove_call(self, chat_id: int) -> None:
-        self.active_calls.pop(chat_id, None)
+        if self.active_calls.pop(chat_id, None) is not None and shard.role == "worker":
+            await self.pinsdb.delete_one({"_id": chat_id, "worker": shard.id})
 
     async def playing(self, chat_id: int, paused: bool = None) -> bool | None:
         if paused is not None:
@@ -285,7 +451,9 @@ class MongoDB:
             await self.authdb.update_one({"_id": chat_id}, {"$pull": {"user_ids": user_id}})
 
     async def set_assistant(self, chat_id: int) -> int:
-        num = random.randint(1, len(userbot.clients)) if userbot.clients else 1
+        # Place new chats on the assistant with the fewest joined chats.
+        nums = sorted(userbot.assistants) or [1]
+        num = min(nums, key=lambda n: (len(reaper.members[n]), random.random()))
         await self.assistantdb.update_one({"_id": chat_id}, {"$set": {"num": num}}, upsert=True)
         self.assistant[chat_id] = num
         return num
@@ -293,9 +461,11 @@ class MongoDB:
     async def get_assistant(self, chat_id: int):
         if chat_id not in self.assistant:
             doc = await self.assistantdb.find_one({"_id": chat_id})
-            num = doc["num"] if doc else await self.set_assistant(chat_id)
+            # Numbers are global session numbers shared by all shard workers; only
+            # reassign when the stored session is no longer configured at all.
+            num = doc["num"] if doc and doc["num"] in shard.sessions else await self.set_assistant(chat_id)
             self.assistant[chat_id] = num
-        return anon.clients[self.assistant[chat_id] - 1] if anon.clients else None
+        return anon.assistants.get(self.assistant[chat_id])
 
     async def get_client(self, chat_id: int):
         if chat_id not in self.assistant:
@@ -412,10 +582,24 @@ class MongoDB:
             self.users.extend([user["_id"] async for user in self.usersdb.find()])
         return self.users
 
+    async def get_file_id(self, key: str) -> str | None:
+        if key not in self.files:
+            doc = await self.filesdb.find_one({"_id": key})
+            self.files[key] = doc["file_id"] if doc else None
+        return self.files[key]
+
+    async def set_file_id(self, key: str, file_id: str | None) -> None:
+        self.files[key] = file_id
+        if file_id:
+            await self.filesdb.update_one({"_id": key}, {"$set": {"file_id": file_id}}, upsert=True)
+        else:
+            await self.filesdb.delete_one({"_id": key})
+
     async def load_cache(self):
         await self.get_chats()
         await self.get_users()
         await self.get_blacklisted(True)
+        await index.load()
         logger.info("Database cache loaded.")
 
 # ==================== HELPER CLASSES ====================
@@ -485,6 +669,10 @@ class Inline:
                 self.ikb(text="‣‣I", callback_data=f"controls skip {chat_id}"),
                 self.ikb(text="▢", callback_data=f"controls stop {chat_id}"),
             ])
+            keyboard.append([
+                self.ikb(text="⟲ 10s", callback_data=f"controls rewind {chat_id}"),
+                self.ikb(text="10s ⟳", callback_data=f"controls forward {chat_id}"),
+            ])
         return self.ikm(keyboard)
 
     def help_markup(self, _lang: dict, back: bool = False):
@@ -568,6 +756,10 @@ class Utilities:
         parts = [int(p) for p in time_str.strip().split(":")]
         return sum(value * 60**i for i, value in enumerate(reversed(parts)))
 
+    def to_duration(self, seconds: int) -> str:
+        h, m, s = seconds // 3600, (seconds % 3600) // 60, seconds % 60
+        return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
     async def extract_user(self, msg: types.Message):
         if msg.reply_to_message:
             return msg.reply_to_message.from_user
@@ -590,21 +782,170 @@ class Utilities:
     async def play_log(self, m: types.Message, title: str, duration: str):
         if m.chat.id == app.logger:
             return
-        _text = f"🎵 **Play Log**\n\n**Bot:** {app.name}\n**Chat:** {m.chat.id}\n**Title:** {m.chat.title}\n**User:** {m.from_user.id}\n**Mention:** {m.from_user.mention}\n**Message:** {m.link}\n**Track:** {title}\n**Duration:** {duration}"
-        await app.send_message(chat_id=app.logger, text=_text)
+        await digest.add(f"🎵 {title} ({duration}) in {m.chat.title} [{m.chat.id}] by {m.from_user.mention} - {m.link}")
+
+    async def error_log(self, text: str):
+        try:
+            await app.send_message(chat_id=app.logger, text=f"⚠️ **Error**\n\n{text[:4000]}")
+        except Exception:
+            pass
+
+    async def send_photo(self, photo: str, send) -> types.Message:
+        file_id = await db.get_file_id(photo)
+        if file_id:
+            try:
+                return await send(file_id)
+            except (MediaEmpty, FileReferenceExpired, ValueError):
+                await db.set_file_id(photo, None)
+
+        sent = await send(photo)
+        if sent and sent.photo:
+            await db.set_file_id(photo, sent.photo.file_id)
+        return sent
 
     async def send_log(self, m: types.Message, chat: bool = False):
         if chat:
             user = m.from_user
-            text = f"💬 **New Group**\n\n**Chat ID:** {m.chat.id}\n**Title:** {m.chat.title}\n**User ID:** {user.id if user else 0}\n**User:** {user.mention if user else 'Anonymous'}"
+            text = f"💬 New group: {m.chat.title} [{m.chat.id}] added by {user.mention if user else 'Anonymous'}"
         else:
-            text = f"👤 **New User**\n\n**User ID:** {m.from_user.id}\n**Username:** @{m.from_user.username}\n**Mention:** {m.from_user.mention}"
-        await app.send_message(chat_id=app.logger, text=text)
+            text = f"👤 New user: {m.from_user.mention} [{m.from_user.id}] @{m.from_user.username}"
+        await digest.add(text)
+
+class LogDigest:
+    def __init__(self):
+        self.events = []
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    async def add(self, text: str) -> None:
+        self.events.append(text)
+        # Flush in the background so a FloodWait never stalls the handler that logged.
+        if len(self.events) >= config.LOG_DIGEST_SIZE and not (self.task and not self.task.done()):
+            self.task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        async with self.lock:
+            events, self.events = self.events, []
+            if not events:
+                return
+            chunks, text = [], f"📋 **Activity Digest** ({len(events)} events)\n"
+            for event in events:
+                if len(text) + len(event) > 4000:
+                    chunks.append(text)
+                    text = ""
+                text += f"\n{event}"
+            chunks.append(text)
+            for chunk in chunks:
+                for _ in range(3):
+                    try:
+                        await app.send_message(chat_id=app.logger, text=chunk, disable_web_page_preview=True)
+                        break
+                    except FloodWait as e:
+                        await asyncio.sleep(e.value)
+                    except Exception as e:
+                        logger.warning(f"Failed to send log digest: {e}")
+                        break
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(config.LOG_DIGEST_INTERVAL)
+            await self.flush()
+
+class MediaStore:
+    def __init__(self):
+        self.root = config.MEDIA_STORE
+
+    def _hash(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _ref(self, key: str) -> str:
+        return os.path.join(self.root, "refs", self._hash(key))
+
+    def _object(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _link(self, src: str, dest: str) -> None:
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        temp = f"{dest}.link"
+        try:
+            os.link(src, temp)
+        except OSError:
+            # Different filesystem: reflink where supported, plain copy otherwise.
+            if subprocess.run(["cp", "--reflink=auto", src, temp], capture_output=True).returncode != 0:
+                shutil.copyfile(src, temp)
+        os.replace(temp, dest)
+
+    def _fetch(self, key: str, dest: str) -> bool:
+        try:
+            with open(self._ref(key)) as f:
+                digest = f.read().strip()
+        except OSError:
+            return False
+        if not os.path.exists(self._object(digest)):
+            return False
+        self._link(self._object(digest), dest)
+        return True
+
+    def _publish(self, key: str, path: str) -> None:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        if not os.path.exists(self._object(digest)):
+            self._link(path, self._object(digest))
+
+        ref = self._ref(key)
+        os.makedirs(os.path.dirname(ref), exist_ok=True)
+        with open(f"{ref}.part", "w") as f:
+            f.write(digest)
+        os.replace(f"{ref}.part", ref)
+
+    async def get(self, key: str, dest: str) -> bool:
+        if not self.root:
+            return False
+        try:
+            return await asyncio.to_thread(self._fetch, key, dest)
+        except OSError as e:
+            logger.warning(f"Media store fetch failed for {key}: {e}")
+            return False
+
+    async def put(self, key: str, path: str) -> None:
+        if not self.root or not path:
+            return
+        try:
+            await asyncio.to_thread(self._publish, key, path)
+        except OSError as e:
+            logger.warning(f"Media store publish failed for {key}: {e}")
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key: str):
+        if not self.root:
+            yield
+            return
+        os.makedirs(os.path.join(self.root, "locks"), exist_ok=True)
+        fd = os.open(os.path.join(self.root, "locks", f"{self._hash(key)}.lock"), os.O_CREAT | os.O_RDWR)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(0.5)
+            yield
+        finally:
+            os.close(fd)
 
 class Thumbnail:
     def __init__(self):
         self.rect = (914, 514)
         self.fill = (255, 255, 255)
+        self.mask = None
+        self.font1 = self.font2 = None
+
+    def load(self):
+        if self.mask is not None:
+            return
         self.mask = Image.new("L", self.rect, 0)
         try:
             self.font1 = ImageFont.truetype("arial.ttf", 30)
@@ -623,10 +964,11 @@ class Thumbnail:
         try:
             temp = f"cache/temp_{song.id}.jpg"
             output = f"cache/{song.id}.png"
-            if os.path.exists(output):
+            if os.path.exists(output) or await store.get(f"thumb/{song.id}.png", output):
                 return output
 
             await self.save_thumb(temp, song.thumbnail)
+            self.load()
             thumb = Image.open(temp).convert("RGBA").resize(size, Image.Resampling.LANCZOS)
             blur = thumb.filter(ImageFilter.GaussianBlur(25))
             image = ImageEnhance.Brightness(blur).enhance(.40)
@@ -646,27 +988,492 @@ class Thumbnail:
 
             image.save(output)
             os.remove(temp)
+            await store.put(f"thumb/{song.id}.png", output)
             return output
         except:
             return config.DEFAULT_THUMB
 
+class CookiePool:
+    def __init__(self):
+        self.path = "anony/cookies"
+        self.stats = {}
+        self.checked = False
+        self.errors = ("sign in to confirm", "cookies", "login required", "http error 403", "http error 429")
+
+    def load(self) -> None:
+        if os.path.exists(self.path):
+            for file in os.listdir(self.path):
+                if file.endswith(".txt"):
+                    self.stats.setdefault(f"{self.path}/{file}", {"success": 1.0, "latency": 0.0, "failures": 0, "cooldown": 0.0})
+        self.checked = True
+
+    def score(self, cookie: str) -> float:
+        stats = self.stats[cookie]
+        return stats["success"] / (1 + stats["latency"] / 10)
+
+    def get(self) -> str | None:
+        if not self.checked:
+            self.load()
+        now = time.time()
+        ready = [cookie for cookie, stats in self.stats.items() if stats["cooldown"] <= now]
+        return max(ready, key=lambda c: self.score(c) + random.random() / 100) if ready else None
+
+    def is_cookie_error(self, error: str) -> bool:
+        error = error.lower()
+        return any(e in error for e in self.errors)
+
+    def report(self, cookie: str | None, ok: bool, latency: float = 0.0, error: str = "") -> None:
+        stats = self.stats.get(cookie)
+        if not stats:
+            return
+        if ok:
+            stats["success"] = 0.8 * stats["success"] + 0.2
+            stats["latency"] = 0.8 * stats["latency"] + 0.2 * latency if stats["latency"] else latency
+            stats["failures"] = 0
+        elif self.is_cookie_error(error):
+            stats["success"] *= 0.8
+            stats["failures"] += 1
+            cooldown = min(3600, 60 * 2 ** (stats["failures"] - 1))
+            stats["cooldown"] = time.time() + cooldown
+            logger.warning(f"Cookie {cookie} failed {stats['failures']} time(s), cooling down for {cooldown}s.")
+        else:
+            stats["success"] = 0.95 * stats["success"] + 0.05
+
+    async def fetch(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        async with aiohttp.ClientSession() as session:
+            for i, url in enumerate(config.COOKIES_URL):
+                raw = f"https://batbin.me/raw/{url.rstrip('/').split('/')[-1]}"
+                try:
+                    async with session.get(raw, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                        resp.raise_for_status()
+                        data = await resp.read()
+                except Exception as e:
+                    logger.warning(f"Failed to fetch cookies from {url}: {e}")
+                    continue
+
+                cookie = f"{self.path}/remote_{i}.txt"
+                with open(f"{cookie}.part", "wb") as f:
+                    f.write(data)
+                os.replace(f"{cookie}.part", cookie)
+                stats = self.stats.setdefault(cookie, {"success": 1.0, "latency": 0.0, "failures": 0, "cooldown": 0.0})
+                stats["cooldown"] = 0.0
+        self.load()
+
+    async def refresh(self):
+        while True:
+            await self.fetch()
+            await asyncio.sleep(config.COOKIES_REFRESH)
+
+class SearchIndex:
+    def __init__(self):
+        self.tracks = {}
+        self.entries = []
+        self.grams = defaultdict(set)
+        self.noise = {"lyrics", "lyric", "official", "video", "audio", "song", "music", "full", "hd", "hq", "4k", "mv", "ft", "feat"}
+
+    def tokens(self, text: str) -> list[str]:
+        return [t for t in re.findall(r"\w+", text.lower()) if t not in self.noise]
+
+    def trigrams(self, text: str) -> set[str]:
+        grams = set()
+        for token in self.tokens(text):
+            padded = f"  {token} "
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return grams
+
+    def covers(self, query: list[str], tokens: set[str]) -> bool:
+        # Every query word has to appear in the entry, allowing for typos. Extra words
+        # such as "remix" or "live" ask for a different upload, not the base track.
+        for word in query:
+            if word in tokens:
+                continue
+            grams = self.trigrams(word)
+            if not any(2 * len(grams & self.trigrams(t)) / (len(grams) + len(self.trigrams(t))) >= 0.5 for t in tokens):
+                return False
+        return True
+
+    def _index(self, video_id: str, text: str) -> None:
+        grams = self.trigrams(text)
+        if not grams:
+            return
+        self.entries.append((video_id, grams, set(self.tokens(text))))
+        for gram in grams:
+            self.grams[gram].add(len(self.entries) - 1)
+
+    async def load(self) -> None:
+        async for doc in db.tracksdb.find():
+            video_id = doc.pop("_id")
+            aliases = doc.pop("aliases", [])
+            self.tracks[video_id] = doc
+            self._index(video_id, f"{doc['title']} {doc['channel']}")
+            for alias in aliases:
+                self._index(video_id, alias)
+        logger.info(f"Search index loaded with {len(self.tracks)} tracks.")
+
+    async def add(self, data: dict, query: str | None = None) -> None:
+        video_id = data["id"]
+        if video_id not in self.tracks:
+            self.tracks[video_id] = {k: data.get(k) for k in ("title", "channel", "duration", "views")}
+            self._index(video_id, f"{data.get('title', '')} {data.get('channel', '')}")
+        update = {"$set": self.tracks[video_id]}
+        if query:
+            self._index(video_id, query)
+            update["$addToSet"] = {"aliases": query.lower()}
+        await db.tracksdb.update_one({"_id": video_id}, update, upsert=True)
+
+    async def add_many(self, items: list[dict]) -> None:
+        new = [data for data in items if data.get("id") and data["id"] not in self.tracks]
+        for data in new:
+            self.tracks[data["id"]] = {k: data.get(k) for k in ("title", "channel", "duration", "views")}
+            self._index(data["id"], f"{data.get('title', '')} {data.get('channel', '')}")
+        if new:
+            await db.tracksdb.bulk_write([UpdateOne({"_id": d["id"]}, {"$set": self.tracks[d["id"]]}, upsert=True) for d in new], ordered=False)
+
+    def lookup(self, query: str) -> dict | None:
+        grams = self.trigrams(query)
+        if not grams:
+            return None
+        overlap = defaultdict(int)
+        for gram in grams:
+            for entry in self.grams.get(gram, ()):
+                overlap[entry] += 1
+        if not overlap:
+            return None
+
+        # Dice coefficient over word trigrams: tolerant to typos and word order.
+        query = self.tokens(query)
+        scores = sorted(((2 * n / (len(grams) + len(self.entries[e][1])), e) for e, n in overlap.items()), reverse=True)
+        for score, entry in scores:
+            if score < config.SEARCH_THRESHOLD:
+                return None
+            video_id, _, tokens = self.entries[entry]
+            if self.covers(query, tokens):
+                return {"id": video_id, **self.tracks[video_id]}
+        return None
+
+class Popularity:
+    def __init__(self):
+        self.pending = {}
+        self.pinned = set()
+        # Forward decay: each request adds exp(rate * (t - epoch)), so stored scores rank
+        # exactly like exponentially decayed counts without ever rewriting old entries.
+        # Scores are kept as logarithms, since the weights themselves overflow a double.
+        self.epoch = 1_700_000_000
+        self.rate = math.log(2) / config.POPULAR_HALF_LIFE
+
+    @staticmethod
+    def logaddexp(a: float | None, b: float) -> float:
+        if a is None:
+            return b
+        return max(a, b) + math.log1p(math.exp(-abs(a - b)))
+
+    def record(self, video_id: str) -> None:
+        self.pending[video_id] = self.logaddexp(self.pending.get(video_id), self.rate * (time.time() - self.epoch))
+
+    def _update(self, video_id: str, score: float) -> UpdateOne:
+        # logaddexp(stored, score) as an update pipeline, so concurrent flushes stay atomic.
+        combined = {"$add": [{"$max": ["$log_score", score]}, {"$ln": {"$add": [1, {"$exp": {"$multiply": [-1, {"$abs": {"$subtract": ["$log_score", score]}}]}}]}}]}
+        return UpdateOne({"_id": video_id}, [{"$set": {"log_score": {"$cond": [{"$eq": [{"$type": "$log_score"}, "missing"]}, score, combined]}}}], upsert=True)
+
+    async def flush(self) -> None:
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        await db.popularitydb.bulk_write([self._update(vid, score) for vid, score in pending.items()], ordered=False)
+
+    async def top(self, limit: int) -> list[str]:
+        return [doc["_id"] async for doc in db.popularitydb.find({"log_score": {"$exists": True}}).sort("log_score", -1).limit(limit)]
+
+    def idle(self) -> bool:
+        return psutil.cpu_percent(interval=None) < config.CPU_LOW
+
+    async def warm(self) -> None:
+        self.pinned = set(await self.top(config.POPULAR_TRACKS))
+        for video_id in self.pinned:
+            if not self.idle():
+                return
+            if not os.path.exists(f"downloads/{video_id}.webm"):
+                await yt.download(video_id)
+            if video_id in index.tracks:
+                await thumb.generate(yt.track({"id": video_id, **index.tracks[video_id]}, 0))
+
+    def evict(self, playing: set[str]) -> None:
+        groups = defaultdict(list)
+        for file in os.scandir("downloads"):
+            if file.is_file():
+                groups[file.name.split(".")[0]].append(file)
+
+        total = sum(f.stat().st_size for files in groups.values() for f in files)
+        candidates = sorted(
+            (max(f.stat().st_mtime for f in files), stem)
+            for stem, files in groups.items()
+            if stem not in self.pinned and not any(f.path in playing or f.name.endswith((".part", ".index", ".link")) for f in files)
+        )
+        for _, stem in candidates:
+            if total <= config.CACHE_LIMIT:
+                break
+            for f in groups[stem]:
+                total -= f.stat().st_size
+                os.remove(f.path)
+            logger.info(f"Evicted {stem} from download cache.")
+
+    async def run(self):
+        rounds = 0
+        while True:
+            await asyncio.sleep(60)
+            rounds += 1
+            try:
+                await self.flush()
+                if rounds % 10 == 0:
+                    if config.POPULAR_TRACKS and self.idle():
+                        await self.warm()
+                    if config.CACHE_LIMIT:
+                        playing = {media.file_path for items in queue.queues.values() for media in items if media.file_path}
+                        await asyncio.to_thread(self.evict, playing)
+            except Exception as e:
+                logger.warning(f"Popularity job failed: {e}")
+
+class Extractor:
+    def __init__(self, keys: int = 8, size: int = 256, files: int = 2000):
+        self.keys = keys
+        self.size = size
+        self.files = files
+        self.lock = threading.Lock()
+        self.pools = OrderedDict()
+        self.info = OrderedDict()
+        self.path = "downloads/info"
+        os.makedirs(self.path, exist_ok=True)
+
+    def options(self, cookie: str | None, video: bool) -> dict:
+        base_opts = {
+            "outtmpl": "downloads/%(id)s.%(ext)s",
+            "quiet": True,
+            "noplaylist": True,
+            "geo_bypass": True,
+            "no_warnings": True,
+            "overwrites": False,
+            "nocheckcertificate": True,
+            "cookiefile": cookie,
+        }
+        if video:
+            return {**base_opts, "format": "(bestvideo[height<=?720][width<=?1280][ext=mp4])+(bestaudio)", "merge_output_format": "mp4"}
+        return {**base_opts, "format": "bestaudio[ext=webm][acodec=opus]"}
+
+    def acquire(self, cookie: str | None, video: bool):
+        with self.lock:
+            pool = self.pools.setdefault((cookie, video), [])
+            self.pools.move_to_end((cookie, video))
+            if pool:
+                return pool.pop()
+        return yt_dlp.YoutubeDL(self.options(cookie, video))
+
+    def release(self, cookie: str | None, video: bool, ydl) -> None:
+        closing = []
+        with self.lock:
+            pool = self.pools.get((cookie, video))
+            if pool is not None and len(pool) < config.EXTRACTOR_POOL:
+                pool.append(ydl)
+            else:
+                closing.append(ydl)
+            while len(self.pools) > self.keys:
+                closing.extend(self.pools.popitem(last=False)[1])
+        for ydl in closing:
+            ydl.close()
+
+    def expiry(self, info: dict) -> float:
+        stamps = []
+        for f in info.get("formats") or []:
+            if match := re.search(r"[?&/]expire[=/](\d+)", f.get("url") or ""):
+                stamps.append(int(match.group(1)))
+        # Stop reusing the format URLs a few minutes before YouTube stops signing them.
+        return (min(stamps) if stamps else time.time() + 3600) - 300
+
+    def get_info(self, video_id: str, cookie: str | None) -> dict | None:
+        with self.lock:
+            entry = self.info.get(video_id)
+        if entry is None:
+            try:
+                with open(f"{self.path}/{video_id}.json") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if entry["expires"] <= time.time():
+            self.drop(video_id)
+            return None
+        # Signed URLs are tied to the session that extracted them.
+        if entry.get("cookie") != cookie:
+            return None
+        with self.lock:
+            self.info[video_id] = entry
+            self.info.move_to_end(video_id)
+            while len(self.info) > self.size:
+                self.info.popitem(last=False)
+        return entry["info"]
+
+    def set_info(self, video_id: str, info: dict, cookie: str | None) -> dict:
+        entry = {"expires": self.expiry(info), "cookie": cookie, "info": yt_dlp.YoutubeDL.sanitize_info(info)}
+        with self.lock:
+            self.info[video_id] = entry
+            while len(self.info) > self.size:
+                self.info.popitem(last=False)
+        tmp = f"{self.path}/{video_id}.json.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(entry, f)
+            # The mtime carries the expiry, so prune() never has to parse the files.
+            os.utime(tmp, (entry["expires"], entry["expires"]))
+            os.replace(tmp, f"{self.path}/{video_id}.json")
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Failed to cache info for {video_id}: {e}")
+        return entry["info"]
+
+    def drop(self, video_id: str) -> None:
+        with self.lock:
+            self.info.pop(video_id, None)
+        with contextlib.suppress(OSError):
+            os.remove(f"{self.path}/{video_id}.json")
+
+    def extract(self, ydl, video_id: str, cookie: str | None) -> dict:
+        info = ydl.extract_info(yt.base + video_id, download=False, process=False)
+        return self.set_info(video_id, info, cookie)
+
+    def prune(self) -> None:
+        now = time.time()
+        files = []
+        for file in os.scandir(self.path):
+            stat = file.stat()
+            if file.name.endswith(".json"):
+                if stat.st_mtime > now:
+                    files.append((stat.st_mtime, file))
+                    continue
+            elif stat.st_ctime > now - 3600:
+                # A write may still be in progress.
+                continue
+            self.drop(file.name.split(".")[0])
+            with contextlib.suppress(OSError):
+                os.remove(file.path)
+        # Over budget: drop the entries that would expire first.
+        for _, file in sorted(files, key=lambda f: f[0])[:max(0, len(files) - self.files)]:
+            self.drop(file.name.split(".")[0])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(600)
+            try:
+                await asyncio.to_thread(self.prune)
+            except Exception as e:
+                logger.warning(f"Failed to prune extractor cache: {e}")
+
+    def download(self, video_id: str, cookie: str | None, video: bool) -> None:
+        # Extraction is format independent, so /play and /vplay share the cached info
+        # and only format selection and the download run again.
+        ydl = self.acquire(cookie, video)
+        try:
+            info = self.get_info(video_id, cookie)
+            if info is None:
+                return ydl.process_ie_result(copy.deepcopy(self.extract(ydl, video_id, cookie)), download=True)
+            try:
+                ydl.process_ie_result(copy.deepcopy(info), download=True)
+            except Exception as e:
+                logger.info(f"Cached info for {video_id} failed, extracting again: {e}")
+                self.drop(video_id)
+                ydl.process_ie_result(copy.deepcopy(self.extract(ydl, video_id, cookie)), download=True)
+        finally:
+            self.release(cookie, video, ydl)
+
+class SearchRouter:
+    def __init__(self):
+        self.backends = {
+            "youtube_search": self._youtube_search,
+            "youtubesearchpython": self._youtubesearchpython,
+            "ytdlp": self._ytdlp,
+        }
+        self.names = [n for n in config.SEARCH_BACKENDS if n in self.backends] or ["youtube_search"]
+        self.latency = {n: deque(maxlen=50) for n in self.names}
+        self.errors = {n: 0.0 for n in self.names}
+
+    def _youtube_search(self, query: str, limit: int) -> list[dict]:
+        return youtube_search.YoutubeSearch(query, max_results=limit).to_dict()
+
+    def _youtubesearchpython(self, query: str, limit: int) -> list[dict]:
+        results = youtubesearchpython.VideosSearch(query, limit=limit).result()["result"]
+        return [{
+            "id": r["id"],
+            "title": r.get("title"),
+            "channel": (r.get("channel") or {}).get("name"),
+            "duration": r.get("duration"),
+            "views": (r.get("viewCount") or {}).get("short"),
+        } for r in results if r.get("type", "video") == "video"]
+
+    def _ytdlp(self, query: str, limit: int) -> list[dict]:
+        opts = {"quiet": True, "no_warnings": True, "extract_flat": True, "skip_download": True}
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(f"ytsearch{limit}:{query}", download=False)
+        return [{
+            "id": e["id"],
+            "title": e.get("title"),
+            "channel": e.get("channel") or e.get("uploader"),
+            "duration": utils.to_duration(int(e["duration"])) if e.get("duration") else None,
+            "views": f"{e['view_count']:,} views" if e.get("view_count") else None,
+        } for e in info.get("entries") or []]
+
+    def percentile(self, name: str, pct: int) -> float:
+        samples = sorted(self.latency[name])
+        if len(samples) < 5:
+            return 1.5
+        return samples[min(len(samples) - 1, len(samples) * pct // 100)]
+
+    def score(self, name: str) -> float:
+        # Median latency, inflated by the recent error rate.
+        return self.percentile(name, 50) * (1 + 4 * self.errors[name])
+
+    def ranked(self) -> list[str]:
+        return sorted(self.names, key=self.score)
+
+    def record(self, name: str, latency: float, ok: bool) -> None:
+        self.latency[name].append(latency)
+        self.errors[name] = 0.9 * self.errors[name] + (0.0 if ok else 0.1)
+
+    async def _run(self, name: str, query: str, limit: int) -> list[dict]:
+        start = time.monotonic()
+        try:
+            results = await asyncio.to_thread(self.backends[name], query, limit)
+        except asyncio.CancelledError:
+            # A cancelled loser was at least this slow.
+            self.record(name, time.monotonic() - start, True)
+            raise
+        except Exception as e:
+            self.record(name, time.monotonic() - start, False)
+            logger.debug(f"Search backend {name} failed: {e}")
+            raise
+        self.record(name, time.monotonic() - start, True)
+        return results
+
+    async def search(self, query: str, limit: int = 1) -> list[dict]:
+        order = self.ranked()
+        delay = max(self.percentile(order[0], config.SEARCH_HEDGE), 0.3)
+        running = {asyncio.create_task(self._run(order.pop(0), query, limit))}
+        try:
+            while running:
+                done, running = await asyncio.wait(running, timeout=delay if order else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.exception() and task.result():
+                        return task.result()
+                # Primary is slow or came back empty: hedge with the next best backend.
+                if order and (not done or not running):
+                    running.add(asyncio.create_task(self._run(order.pop(0), query, limit)))
+            return []
+        finally:
+            for task in running:
+                task.cancel()
+
 class YouTube:
     def __init__(self):
         self.base = "https://www.youtube.com/watch?v="
-        self.cookies = []
-        self.checked = False
         self.warned = False
         self.regex = re.compile(r"(https?://)?(www\.|m\.|music\.)?(youtube\.com/(watch\?v=|shorts/|playlist\?list=)|youtu\.be/)([A-Za-z0-9_-]{11}|PL[A-Za-z0-9_-]+)([&?][^\s]*)?")
 
-    def get_cookies(self):
-        if not self.checked:
-            if os.path.exists("anony/cookies"):
-                for file in os.listdir("anony/cookies"):
-                    if file.endswith(".txt"):
-                        self.cookies.append(f"anony/cookies/{file}")
-            self.checked = True
-        return random.choice(self.cookies) if self.cookies else None
-
     def valid(self, url: str) -> bool:
         return bool(re.match(self.regex, url))
 
@@ -695,27 +1502,42 @@ class YouTube:
             return link.split("&si")[0].split("?si")[0]
         return None
 
+    def track(self, data: dict, m_id: int, video: bool = False) -> Track:
+        return Track(
+            id=data.get("id"),
+            channel_name=data.get("channel") or "Unknown",
+            duration=data.get("duration") or "0:00",
+            duration_sec=utils.to_seconds(data.get("duration") or "0:00"),
+            message_id=m_id,
+            title=(data.get("title") or "Unknown")[:25],
+            thumbnail=f"https://i.ytimg.com/vi/{data.get('id')}/hqdefault.jpg",
+            url=f"https://youtube.com/watch?v={data.get('id')}",
+            view_count=data.get("views") or "N/A",
+            video=video,
+        )
+
     async def search(self, query: str, m_id: int, video: bool = False) -> Track | None:
+        url = self.valid(query)
+        if not url and (data := index.lookup(query)):
+            return self.track(data, m_id, video)
         try:
-            results = YoutubeSearch(query, max_results=1).to_dict()
+            results = await router.search(query, 1)
             if results:
                 data = results[0]
-                return Track(
-                    id=data.get("id"),
-                    channel_name=data.get("channel", "Unknown"),
-                    duration=data.get("duration", "0:00"),
-                    duration_sec=utils.to_seconds(data.get("duration", "0:00")),
-                    message_id=m_id,
-                    title=data.get("title", "Unknown")[:25],
-                    thumbnail=f"https://i.ytimg.com/vi/{data.get('id')}/hqdefault.jpg",
-                    url=f"https://youtube.com/watch?v={data.get('id')}",
-                    view_count=data.get("views", "N/A"),
-                    video=video,
-                )
+                await index.add(data, None if url else query)
+                return self.track(data, m_id, video)
         except:
             pass
         return None
 
+    async def results(self, query: str, limit: int = 5) -> list[dict]:
+        try:
+            results = await router.search(query, limit)
+        except:
+            return []
+        await index.add_many(results)
+        return results
+
     async def playlist(self, limit: int, user: str, url: str, video: bool) -> list[Track | None]:
         tracks = []
         try:
@@ -727,53 +1549,293 @@ class YouTube:
         return tracks
 
     async def download(self, video_id: str, video: bool = False) -> Optional[str]:
-        url = self.base + video_id
         ext = "mp4" if video else "webm"
         filename = f"downloads/{video_id}.{ext}"
 
-        if os.path.exists(filename):
-            return filename
+        if not os.path.exists(filename):
+            key = f"yt/{video_id}.{ext}"
+            async with store.lock(key):
+                if not await store.get(key, filename):
+                    if not await self._download(video_id, filename, video):
+                        return None
+                    await store.put(key, filename)
 
-        cookie = self.get_cookies()
-        base_opts = {
-            "outtmpl": "downloads/%(id)s.%(ext)s",
-            "quiet": True,
-            "noplaylist": True,
-            "geo_bypass": True,
-            "no_warnings": True,
-            "overwrites": False,
-            "nocheckcertificate": True,
-            "cookiefile": cookie,
-        }
+        transcoder.submit(filename, video)
+        return filename
 
-        if video:
-            ydl_opts = {**base_opts, "format": "(bestvideo[height<=?720][width<=?1280][ext=mp4])+(bestaudio)", "merge_output_format": "mp4"}
-        else:
-            ydl_opts = {**base_opts, "format": "bestaudio[ext=webm][acodec=opus]"}
+    async def _download(self, video_id: str, filename: str, video: bool) -> Optional[str]:
+        cookie = cookies.get()
 
         def _download():
+            start = time.monotonic()
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
+                extractor.download(video_id, cookie, video)
+                cookies.report(cookie, True, time.monotonic() - start)
                 return filename
-            except:
-                if cookie in self.cookies:
-                    self.cookies.remove(cookie)
+            except Exception as e:
+                cookies.report(cookie, False, error=str(e))
                 return None
 
         return await asyncio.to_thread(_download)
 
+class Spotify:
+    def __init__(self):
+        self.regex = re.compile(r"(https?://)?open\.spotify\.com/(intl-[a-z]+/)?(track|album|playlist)/([A-Za-z0-9]+)")
+        self.token = None
+        self.expires = 0.0
+        self.limit = asyncio.Semaphore(5)
+
+    def valid(self, url: str) -> bool:
+        return bool(re.match(self.regex, url))
+
+    async def auth(self, session: aiohttp.ClientSession) -> str:
+        if self.token and time.time() < self.expires:
+            return self.token
+        auth = aiohttp.BasicAuth(config.SPOTIFY_CLIENT_ID, config.SPOTIFY_CLIENT_SECRET)
+        async with session.post(config.SPOTIFY_AUTH_URL, data={"grant_type": "client_credentials"}, auth=auth) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        self.token = data["access_token"]
+        self.expires = time.time() + data.get("expires_in", 3600) - 60
+        return self.token
+
+    async def get(self, session: aiohttp.ClientSession, url: str, **params) -> dict:
+        for _ in range(3):
+            headers = {"Authorization": f"Bearer {await self.auth(session)}"}
+            async with session.get(url, params=params or None, headers=headers) as resp:
+                if resp.status == 429:
+                    await asyncio.sleep(int(resp.headers.get("Retry-After", 1)))
+                    continue
+                if resp.status == 401:
+                    self.token = None
+                    continue
+                resp.raise_for_status()
+                return await resp.json()
+        raise aiohttp.ClientError(f"Spotify request failed: {url}")
+
+    async def tracks(self, url: str, limit: int) -> list[dict]:
+        match = re.match(self.regex, url)
+        kind, spotify_id = match.group(3), match.group(4)
+        api = config.SPOTIFY_API_URL
+        items = []
+        async with aiohttp.ClientSession() as session:
+            if kind == "track":
+                items = (await self.get(session, f"{api}/tracks", ids=spotify_id))["tracks"]
+            else:
+                # Walk the paged track lists with the largest page size each endpoint allows.
+                if kind == "album":
+                    page = await self.get(session, f"{api}/albums/{spotify_id}/tracks", limit=50)
+                else:
+                    page = await self.get(session, f"{api}/playlists/{spotify_id}/tracks", limit=100, fields="items(track(id,name,artists(name),duration_ms)),next")
+                while page:
+                    items.extend(i["track"] if "track" in i else i for i in page["items"])
+                    if len(items) >= limit or not page.get("next"):
+                        break
+                    page = await self.get(session, page["next"])
+
+        return [{
+            "id": t["id"],
+            "name": t["name"],
+            "artists": ", ".join(a["name"] for a in t.get("artists", [])),
+            "duration": t.get("duration_ms", 0) // 1000,
+        } for t in items if t and t.get("id")][:limit]
+
+    async def find(self, item: dict) -> dict | None:
+        async with self.limit:
+            results = await router.search(f"{item['artists']} {item['name']}", 3)
+        if not results:
+            return None
+        # Prefer the upload whose length matches the Spotify track, which skips most
+        # extended mixes and music videos with intros.
+        data = min(results, key=lambda r: abs(utils.to_seconds(r.get("duration") or "0:00") - item["duration"]))
+        data = {k: data.get(k) for k in ("id", "title", "channel", "duration", "views")}
+        await db.spotifydb.update_one({"_id": item["id"]}, {"$set": data}, upsert=True)
+        await index.add(data)
+        return data
+
+    async def resolve(self, url: str, m_id: int, video: bool) -> list[asyncio.Future]:
+        items = await self.tracks(url, config.PLAYLIST_LIMIT)
+        cached = {}
+        async for doc in db.spotifydb.find({"_id": {"$in": [i["id"] for i in items]}}):
+            cached[doc.pop("_id")] = doc
+
+        async def _resolve(n: int, item: dict) -> Track | None:
+            data = cached.get(item["id"]) or await self.find(item)
+            return yt.track(data, m_id if n == 0 else 0, video) if data else None
+
+        return [asyncio.ensure_future(_resolve(n, item)) for n, item in enumerate(items)]
+
+    async def enqueue(self, chat_id: int, pending: list[asyncio.Future], user: str) -> None:
+        added = 0
+        try:
+            for future in pending:
+                try:
+                    track = await future
+                except Exception as e:
+                    logger.warning(f"Spotify track failed to resolve in {chat_id}: {e}")
+                    continue
+                if not track or track.duration_sec > config.DURATION_LIMIT:
+                    continue
+                # Stop once the queue was cleared or filled while we were resolving.
+                if not queue.get_current(chat_id) or len(queue.get_queue(chat_id)) >= config.QUEUE_LIMIT:
+                    break
+                track.user = user
+                queue.add(chat_id, track)
+                added += 1
+        finally:
+            for future in pending:
+                future.cancel()
+        if added:
+            preloader.schedule(chat_id)
+            await app.send_message(chat_id, f"Added {added} more tracks from Spotify to the queue.")
+
+class InlineSearch:
+    def __init__(self, size: int = 2000):
+        self.size = size
+        self.cache = OrderedDict()
+        self.debounce = {}
+        self.inflight = {}
+
+    def _matches(self, data: dict, words: list[str]) -> bool:
+        text = index.tokens(f"{data.get('title', '')} {data.get('channel', '')}")
+        *full, last = words
+        return all(w in text for w in full) and any(t.startswith(last) for t in text)
+
+    def get(self, query: str) -> list[dict] | None:
+        now = time.time()
+        for key in [k for k, (stamp, _) in self.cache.items() if now - stamp > config.INLINE_CACHE_TIME]:
+            del self.cache[key]
+        if query in self.cache:
+            self.cache.move_to_end(query)
+            return self.cache[query][1]
+
+        # While the user keeps typing, narrow the results of the longest cached prefix.
+        words = index.tokens(query)
+        prefixes = [k for k in self.cache if query.startswith(k) and len(k) >= 3]
+        if words and prefixes:
+            results = [d for d in self.cache[max(prefixes, key=len)][1] if self._matches(d, words)]
+            if results:
+                return results
+        return None
+
+    async def _fetch(self, query: str) -> list[dict]:
+        results = await yt.results(query, config.INLINE_RESULTS)
+        self.cache[query] = (time.time(), results)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return results
+
+    async def fetch(self, query: str) -> list[dict]:
+        # Users typing the same query share one search.
+        if query not in self.inflight:
+            task = asyncio.create_task(self._fetch(query))
+            task.add_done_callback(lambda _: self.inflight.pop(query, None))
+            self.inflight[query] = task
+        return await asyncio.shield(self.inflight[query])
+
+    def render(self, results: list[dict]) -> list[types.InlineQueryResultArticle]:
+        articles = []
+        for data in results:
+            url = f"https://youtube.com/watch?v={data['id']}"
+            articles.append(types.InlineQueryResultArticle(
+                id=data["id"],
+                title=data.get("title") or "Unknown",
+                description=f"{data.get('channel') or 'Unknown'} | {data.get('duration') or '0:00'} | {data.get('views') or 'N/A'}",
+                thumb_url=f"https://i.ytimg.com/vi/{data['id']}/hqdefault.jpg",
+                input_message_content=types.InputTextMessageContent(f"<b>{escape(data.get('title') or 'Unknown')}</b>\n{url}"),
+                reply_markup=buttons.ikm([[buttons.ikb(text="YouTube", url=url)]]),
+            ))
+        return articles
+
+    async def reply(self, query: types.InlineQuery, results: list[dict]) -> None:
+        try:
+            await query.answer(self.render(results), cache_time=config.INLINE_CACHE_TIME)
+        except QueryIdInvalid:
+            pass
+
+    async def resolve(self, query: types.InlineQuery, text: str) -> None:
+        try:
+            await asyncio.sleep(config.INLINE_DEBOUNCE)
+            await self.reply(query, await self.fetch(text))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning(f"Inline search failed for {text!r}: {e}")
+        finally:
+            if self.debounce.get(query.from_user.id) is asyncio.current_task():
+                self.debounce.pop(query.from_user.id)
+
+    async def answer(self, query: types.InlineQuery) -> None:
+        text = " ".join(query.query.lower().split())
+        if len(text) < 2:
+            return await query.answer([], cache_time=config.INLINE_CACHE_TIME)
+
+        # A newer keystroke from the same user replaces the pending query.
+        if task := self.debounce.pop(query.from_user.id, None):
+            task.cancel()
+        if (results := self.get(text)) is not None:
+            return await self.reply(query, results)
+        # Resolve outside the handler so typing does not tie up the bot's update workers.
+        self.debounce[query.from_user.id] = asyncio.create_task(self.resolve(query, text))
+
 class Telegram:
     def __init__(self):
-        self.active = []
+        self.active: dict[str, asyncio.Task] = {}
+        self.waiters = defaultdict(dict)
         self.events = {}
         self.last_edit = {}
         self.active_tasks = {}
         self.sleep = 5
+        self.limit = asyncio.Semaphore(config.DOWNLOAD_LIMIT)
+        self.pending: list[str] = []
 
     def get_media(self, msg: types.Message) -> bool:
         return any([msg.video, msg.audio, msg.document, msg.voice])
 
+    def queued(self, file_id: str) -> str:
+        return f"Queued for download: #{self.pending.index(file_id) + 1} in the download queue."
+
+    async def _announce(self, file_ids: list[str]) -> None:
+        for file_id in file_ids:
+            if file_id not in self.pending:
+                continue
+            text = self.queued(file_id)
+            for sent in list(self.waiters[file_id].values()):
+                with contextlib.suppress(Exception):
+                    await sent.edit_text(text, reply_markup=buttons.cancel_dl("Cancel"))
+
+    async def _slot(self, file_id: str) -> None:
+        if not self.limit.locked():
+            return await self.limit.acquire()
+        # The semaphore wakes waiters in order, so the pending list mirrors its queue.
+        self.pending.append(file_id)
+        asyncio.create_task(self._announce([file_id]))
+        try:
+            await self.limit.acquire()
+        finally:
+            index = self.pending.index(file_id)
+            self.pending.remove(file_id)
+            asyncio.create_task(self._announce(self.pending[index:]))
+
+    async def _fetch(self, msg: types.Message, file_id: str, file_path: str, file_ext: str, progress) -> str | None:
+        key = f"tg/{file_id}.{file_ext}"
+        async with store.lock(key):
+            if await store.get(key, file_path):
+                return file_path
+            await self._slot(file_id)
+            try:
+                path = await msg.download(file_name=f"{file_path}.part", progress=progress)
+                if not path:
+                    return None
+                os.replace(path, file_path)
+            finally:
+                self.limit.release()
+            await store.put(key, file_path)
+            return file_path
+
+    async def _wait(self, file_id: str) -> str | None:
+        return await asyncio.shield(self.active[file_id])
+
     async def download(self, msg: types.Message, sent: types.Message) -> Media | None:
         msg_id = sent.id
         event = asyncio.Event()
@@ -783,7 +1845,7 @@ class Telegram:
 
         media = msg.audio or msg.voice or msg.video or msg.document
         file_id = getattr(media, "file_unique_id", None)
-        file_ext = getattr(media, "file_name", "").split(".")[-1] or "mp3"
+        file_ext = (getattr(media, "file_name", None) or "").split(".")[-1] or "mp3"
         file_size = getattr(media, "file_size", 0)
         file_title = getattr(media, "title", "Telegram File") or "Telegram File"
         duration = getattr(media, "duration", 0)
@@ -798,36 +1860,54 @@ class Telegram:
             return None
 
         async def progress(current, total):
-            if event.is_set():
-                return
-
+            # The shared download reports to every requester still waiting on it.
             now = time.time()
-            if now - self.last_edit[msg_id] < self.sleep:
-                return
-
-            self.last_edit[msg_id] = now
             percent = current * 100 / total
             speed = current / (now - start_time or 1e-6)
             eta = utils.format_eta(int((total - current) / speed))
             text = f"Downloading...\n{utils.format_size(current)} / {utils.format_size(total)} ({percent:.1f}%)\nSpeed: {utils.format_size(speed)}/s\nETA: {eta}"
-
-            await sent.edit_text(text, reply_markup=buttons.cancel_dl("Cancel"))
+            for waiter_id, waiter in list(self.waiters[file_id].items()):
+                if now - self.last_edit.get(waiter_id, 0) < self.sleep or self.events.get(waiter_id, event).is_set():
+                    continue
+                self.last_edit[waiter_id] = now
+                with contextlib.suppress(Exception):
+                    await waiter.edit_text(text, reply_markup=buttons.cancel_dl("Cancel"))
 
         try:
             file_path = f"downloads/{file_id}.{file_ext}"
             if not os.path.exists(file_path):
-                if file_id in self.active:
-                    await sent.edit_text("File already being downloaded")
+                if file_id in self.pending:
+                    await sent.edit_text(self.queued(file_id), reply_markup=buttons.cancel_dl("Cancel"))
+                elif file_id in self.active:
+                    await sent.edit_text("File already being downloaded, waiting for it to finish...", reply_markup=buttons.cancel_dl("Cancel"))
+                else:
+                    # The download belongs to no single requester: it keeps running while
+                    # anyone is still waiting and is only cancelled when the last one leaves.
+                    task = asyncio.create_task(self._fetch(msg, file_id, file_path, file_ext, progress))
+                    task.add_done_callback(lambda _: self.active.pop(file_id, None))
+                    self.active[file_id] = task
+                self.waiters[file_id][msg_id] = sent
+                waiter = asyncio.create_task(self._wait(file_id))
+                self.active_tasks[msg_id] = waiter
+                try:
+                    file_path = await waiter
+                except Exception as e:
+                    logger.warning(f"Telegram download failed for {file_id}: {e}")
+                    file_path = None
+                finally:
+                    self.active_tasks.pop(msg_id, None)
+                    self.waiters[file_id].pop(msg_id, None)
+                    if not self.waiters[file_id]:
+                        self.waiters.pop(file_id, None)
+                        if file_id in self.active and not self.active[file_id].done():
+                            self.active[file_id].cancel()
+                if not file_path:
+                    await sent.edit_text("Download failed.")
                     return None
-
-                self.active.append(file_id)
-                task = asyncio.create_task(msg.download(file_name=file_path, progress=progress))
-                self.active_tasks[msg_id] = task
-                await task
-                self.active.remove(file_id)
-                self.active_tasks.pop(msg_id, None)
                 await sent.edit_text(f"Download complete! ({round(time.time() - start_time, 2)}s)")
 
+            transcoder.submit(file_path, video)
+
             return Media(
                 id=file_id,
                 duration=time.strftime("%M:%S", time.gmtime(duration)),
@@ -843,7 +1923,6 @@ class Telegram:
         finally:
             self.events.pop(msg_id, None)
             self.last_edit.pop(msg_id, None)
-            self.active = [f for f in self.active if f != file_id]
 
     async def cancel(self, query: types.CallbackQuery):
         event = self.events.get(query.message.id)
@@ -858,9 +1937,287 @@ class Telegram:
         else:
             await query.answer("No active download found", show_alert=True)
 
+class Watchdog:
+    def __init__(self):
+        self.interval = 0.1
+        self.beat = time.monotonic()
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.running = False
+        self.thread_id = None
+        self.last_report = 0.0
+        self.suppressed = 0
+
+    async def monitor(self):
+        self.thread_id = threading.get_ident()
+        self.running = True
+        threading.Thread(target=self.inspect, name="loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.beat = time.monotonic()
+                self.lag = max(0.0, self.beat - start - self.interval)
+                self.max_lag = max(self.max_lag, self.lag)
+        finally:
+            self.running = False
+
+    def inspect(self):
+        # Runs in its own thread so it can grab the loop thread's stack while the loop is still blocked.
+        threshold = config.LAG_THRESHOLD / 1000
+        reported = None
+        while self.running:
+            time.sleep(threshold / 2)
+            beat = self.beat
+            stalled = time.monotonic() - beat
+            if stalled < threshold or beat == reported:
+                continue
+            reported = beat
+
+            now = time.monotonic()
+            if now - self.last_report < 60:
+                self.suppressed += 1
+                continue
+            self.last_report = now
+
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unavailable\n"
+            suppressed = f" ({self.suppressed} similar reports suppressed)" if self.suppressed else ""
+            self.suppressed = 0
+            logger.warning(f"Event loop blocked for {stalled * 1000:.0f}ms{suppressed}. Stack:\n{stack}")
+
+class Transcoder:
+    def __init__(self):
+        self.jobs = asyncio.Queue()
+        self.pending = set()
+
+    def meta(self, file_path: str) -> dict:
+        try:
+            with open(f"{file_path}.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def set_meta(self, file_path: str, **values) -> None:
+        data = {**self.meta(file_path), **values}
+        with open(f"{file_path}.json.part", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{file_path}.json.part", f"{file_path}.json")
+
+    def target(self, file_path: str, video: bool) -> str:
+        stem = file_path.rsplit(".", 1)[0]
+        return f"{stem}.720p.mkv" if video else f"{stem}.pcm.wav"
+
+    def get(self, file_path: str, video: bool = False) -> str:
+        output = self.target(file_path, video)
+        return output if os.path.exists(output) else file_path
+
+    def submit(self, file_path: str | None, video: bool = False) -> None:
+        if not file_path:
+            return
+        if not self.meta(file_path).get("indexed"):
+            self._queue("index", file_path, video)
+        if config.NORMALIZE and "loudness" not in self.meta(file_path):
+            self._queue("loudness", file_path, video)
+        if config.PRE_TRANSCODE and not os.path.exists(self.target(file_path, video)):
+            self._queue("transcode", file_path, video)
+
+    def _queue(self, kind: str, file_path: str, video: bool) -> None:
+        if (kind, file_path, video) in self.pending:
+            return
+        self.pending.add((kind, file_path, video))
+        self.jobs.put_nowait((kind, file_path, video))
+
+    async def _run(self, *cmd: str) -> tuple[int, str]:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        _, err = await proc.communicate()
+        return proc.returncode, err.decode(errors="ignore").strip()
+
+    async def index(self, file_path: str) -> bool:
+        # Remux so the container carries a complete keyframe index (Matroska cues / MP4 moov)
+        # up front; "-ss" before "-i" then jumps straight to the nearest keyframe.
+        ext = file_path.rsplit(".", 1)[-1].lower()
+        if ext in ("webm", "mkv"):
+            opts, fmt = ["-cues_to_front", "1"], "webm" if ext == "webm" else "matroska"
+        elif ext in ("mp4", "m4a", "mov"):
+            opts, fmt = ["-movflags", "+faststart"], "mp4"
+        else:
+            self.set_meta(file_path, indexed=True)
+            return True
+
+        temp = f"{file_path}.index"
+        code, err = await self._run("ffmpeg", "-y", "-nostdin", "-loglevel", "error", "-i", file_path, "-map", "0", "-c", "copy", *opts, "-f", fmt, temp)
+        if code != 0:
+            if os.path.exists(temp):
+                os.remove(temp)
+            logger.warning(f"Indexing failed for {file_path}: {err[:200]}")
+            return False
+        os.replace(temp, file_path)
+        self.set_meta(file_path, indexed=True)
+        return True
+
+    async def loudness(self, file_path: str) -> dict | None:
+        code, err = await self._run("ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-i", file_path, "-vn", "-af", "ebur128=peak=true", "-f", "null", "-")
+        integrated = re.findall(r"I:\s+(-?[\d.]+) LUFS", err)
+        peak = re.findall(r"Peak:\s+(-?[\d.]+) dBFS", err)
+        if code != 0 or not integrated or not peak:
+            logger.warning(f"Loudness analysis failed for {file_path}")
+            return None
+        result = {"integrated": float(integrated[-1]), "true_peak": float(peak[-1])}
+        self.set_meta(file_path, loudness=result)
+        return result
+
+    def gain(self, file_path: str) -> float:
+        loudness = self.meta(file_path).get("loudness") if config.NORMALIZE else None
+        if not loudness:
+            return 0.0
+        # Single-pass linear gain towards the target, limited so the true peak stays below -1 dBTP.
+        gain = min(config.LOUDNESS_TARGET - loudness["integrated"], -1.0 - loudness["true_peak"])
+        return round(max(-20.0, min(gain, 20.0)), 2)
+
+    async def transcode(self, file_path: str, video: bool) -> str | None:
+        output = self.target(file_path, video)
+        temp = f"{output}.part"
+        # Match AudioQuality.HIGH (48kHz stereo PCM) and VideoQuality.HD_720p (1280x720 @ 30fps)
+        # so ntgcalls can pass the file through without resampling or scaling.
+        cmd = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error", "-i", file_path, "-threads", "2"]
+        if video:
+            cmd += [
+                "-vf", "scale=1280:720:force_original_aspect_ratio=decrease:force_divisible_by=2,fps=30",
+                "-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
+                "-c:a", "pcm_s16le", "-ar", "48000", "-ac", "2", "-cues_to_front", "1", "-f", "matroska", temp,
+            ]
+        else:
+            cmd += ["-vn", "-c:a", "pcm_s16le", "-ar", "48000", "-ac", "2", "-f", "wav", temp]
+
+        code, err = await self._run(*cmd)
+        if code != 0:
+            if os.path.exists(temp):
+                os.remove(temp)
+            logger.warning(f"Transcode failed for {file_path}: {err[:200]}")
+            return None
+        os.replace(temp, output)
+        if config.TRANSCODE_LIMIT:
+            playing = {self.target(m.file_path, m.video) for items in queue.queues.values() for m in items if m.file_path}
+            await asyncio.to_thread(self.evict, playing)
+        return output
+
+    def evict(self, playing: set[str]) -> None:
+        # PCM runs at about 10 MB per minute, so transcodes get their own budget and are
+        # trimmed oldest first; the original downloads stay and are streamed directly.
+        files = sorted(
+            (f.stat().st_mtime, f.stat().st_size, f.path) for f in os.scandir("downloads")
+            if f.is_file() and f.name.endswith((".pcm.wav", ".720p.mkv"))
+        )
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= config.TRANSCODE_LIMIT:
+                break
+            if path in playing:
+                continue
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                total -= size
+
+    async def worker(self):
+        while True:
+            kind, file_path, video = await self.jobs.get()
+            try:
+                if not os.path.exists(file_path):
+                    continue
+                if kind == "index":
+                    await self.index(file_path)
+                elif kind == "loudness":
+                    await self.loudness(file_path)
+                else:
+                    await self.transcode(file_path, video)
+            except Exception as e:
+                logger.warning(f"Media {kind} error for {file_path}: {e}")
+            finally:
+                self.pending.discard((kind, file_path, video))
+                self.jobs.task_done()
+
+class Governor:
+    def __init__(self):
+        self.levels = ["high", "medium", "low"]
+        self.tiers = {
+            "high": (AudioQuality.HIGH, VideoQuality.HD_720p),
+            "medium": (AudioQuality.MEDIUM, VideoQuality.SD_480p),
+            "low": (AudioQuality.LOW, VideoQuality.SD_360p),
+        }
+        self.cpu = 0.0
+        self.pressure = 0
+        self.relief = 0
+        self.streams = {}
+
+    def pick(self) -> str:
+        if self.cpu < config.CPU_LOW:
+            return "high"
+        if self.cpu < config.CPU_HIGH:
+            return "medium"
+        return "low"
+
+    def track(self, chat_id: int, tier: str) -> None:
+        self.streams.pop(chat_id, None)
+        self.streams[chat_id] = tier
+
+    def untrack(self, chat_id: int) -> None:
+        self.streams.pop(chat_id, None)
+
+    def summary(self) -> str:
+        downgraded = sum(1 for tier in self.streams.values() if tier != "high")
+        return f"{self.pick()} ({downgraded}/{len(self.streams)} downgraded)"
+
+    async def _video_chats(self) -> list[int]:
+        chats = []
+        for chat_id in self.streams:
+            media = queue.get_current(chat_id)
+            if media and media.video and await db.get_call(chat_id) and await db.playing(chat_id):
+                chats.append(chat_id)
+        return chats
+
+    async def downgrade(self) -> None:
+        for chat_id in reversed(await self._video_chats()):
+            level = self.levels.index(self.streams[chat_id])
+            if level < len(self.levels) - 1:
+                if await controller.submit(chat_id, "restream", self.levels[level + 1]):
+                    logger.info(f"Downgraded stream in {chat_id} to {self.levels[level + 1]} (CPU {self.cpu:.0f}%)")
+                return
+
+    async def upgrade(self) -> None:
+        for chat_id in await self._video_chats():
+            level = self.levels.index(self.streams[chat_id])
+            if level > 0:
+                if await controller.submit(chat_id, "restream", self.levels[level - 1]):
+                    logger.info(f"Upgraded stream in {chat_id} to {self.levels[level - 1]} (CPU {self.cpu:.0f}%)")
+                return
+
+    async def monitor(self):
+        psutil.cpu_percent()
+        while True:
+            await asyncio.sleep(5)
+            self.cpu = 0.7 * self.cpu + 0.3 * psutil.cpu_percent()
+            if self.cpu > config.CPU_HIGH:
+                self.pressure, self.relief = self.pressure + 1, 0
+            elif self.cpu < config.CPU_LOW:
+                self.pressure, self.relief = 0, self.relief + 1
+            else:
+                self.pressure = self.relief = 0
+
+            try:
+                if self.pressure >= 3:
+                    self.pressure = 0
+                    await self.downgrade()
+                elif self.relief >= 6:
+                    self.relief = 0
+                    await self.upgrade()
+            except Exception as e:
+                logger.warning(f"Quality governor error: {e}")
+
 class TgCall(PyTgCalls):
     def __init__(self):
         self.clients = []
+        self.assistants = {}
 
     async def pause(self, chat_id: int) -> bool:
         client = await db.get_assistant(chat_id)
@@ -884,8 +2241,68 @@ class TgCall(PyTgCalls):
             await client.leave_call(chat_id, close=False)
         except:
             pass
+        governor.untrack(chat_id)
+        preloader.clear(chat_id)
+        audience.clear(chat_id)
+        admission.release(chat_id)
+        if chat_id in db.assistant:
+            reaper.touch(db.assistant[chat_id], chat_id)
+
+    def build_stream(self, media: Media | Track, seek_time: int = 0, tier: str = "high") -> MediaStream:
+        audio_quality, video_quality = governor.tiers[tier]
+        params = []
+        if seek_time > 1:
+            params.append(f"-ss {seek_time}")
+        if gain := transcoder.gain(media.file_path):
+            params.append(f"-atend -af volume={gain}dB")
+
+        return MediaStream(
+            media_path=transcoder.get(media.file_path, media.video),
+            audio_parameters=audio_quality,
+            video_parameters=video_quality,
+            no_video=not media.video,
+            ffmpeg_parameters=" ".join(params) or None,
+        )
+
+    async def restream(self, chat_id: int, tier: str) -> bool:
+        media = queue.get_current(chat_id)
+        if not media or not media.file_path:
+            return False
+        client = await db.get_assistant(chat_id)
+        try:
+            await client.play(chat_id=chat_id, stream=self.build_stream(media, media.time, tier), config=GroupCallConfig(auto_start=False))
+        except Exception:
+            return False
+        governor.streams[chat_id] = tier
+        return True
+
+    def caption(self, media: Media | Track, tier: str) -> str:
+        return f"🎵 **Now Playing**\n\n**Title:** [{media.title}]({media.url})\n**Duration:** {media.duration}\n**Quality:** {tier}\n**Requested by:** {media.user}"
+
+    async def announce(self, chat_id: int, media: Media | Track, prepared: dict) -> None:
+        try:
+            if media.message_id:
+                await app.delete_messages(chat_id=chat_id, message_ids=media.message_id, revoke=True)
+        except:
+            pass
+        try:
+            sent = await utils.send_photo(
+                prepared["thumb"],
+                lambda photo: app.send_photo(chat_id=chat_id, photo=photo, caption=prepared["text"], reply_markup=buttons.controls(chat_id)),
+            )
+            media.message_id = sent.id
+        except Exception as e:
+            logger.warning(f"Failed to announce next track in {chat_id}: {e}")
 
     async def play_media(self, chat_id: int, message: types.Message, media: Media | Track, seek_time: int = 0) -> None:
+        try:
+            await self._play_media(chat_id, message, media, seek_time)
+        finally:
+            # Any start that did not end in a running call gives its capacity back.
+            if not seek_time and not await db.get_call(chat_id):
+                admission.release(chat_id)
+
+    async def _play_media(self, chat_id: int, message: types.Message, media: Media | Track, seek_time: int = 0) -> None:
         client = await db.get_assistant(chat_id)
         _lang = await lang.get_lang(chat_id)
         _thumb = await thumb.generate(media) if isinstance(media, Track) else config.DEFAULT_THUMB
@@ -893,32 +2310,26 @@ class TgCall(PyTgCalls):
         if not media.file_path:
             return await message.edit_text(f"File not found. Please contact {config.SUPPORT_CHAT}")
 
-                    if media.video:
-                stream = MediaStream(
-                    media_path=media.file_path,
-                    audio_parameters=AudioQuality.HIGH,
-                    video_parameters=VideoQuality.HD_720p,
-                    ffmpeg_parameters=f"-ss {seek_time}" if seek_time > 1 else None,
-                )
-            else:
-                stream = MediaStream(
-                    media_path=media.file_path,
-                    audio_parameters=AudioQuality.HIGH,
-                    video_parameters=VideoQuality.HD_720p,
-                    no_video=True,
-                    ffmpeg_parameters=f"-ss {seek_time}" if seek_time > 1 else None,
-                )
+        tier = governor.streams.get(chat_id, "high") if seek_time else governor.pick()
+        stream = self.build_stream(media, seek_time, tier)
+        if not seek_time and (error := await reaper.join(chat_id)):
+            await self.stop(chat_id)
+            return await message.edit_text(error)
         try:
             await client.play(chat_id=chat_id, stream=stream, config=GroupCallConfig(auto_start=False))
+            governor.track(chat_id, tier)
             if not seek_time:
+                reaper.touch(db.assistant[chat_id], chat_id)
+                audience.watch(chat_id, client)
                 media.time = 1
                 await db.add_call(chat_id)
-                text = f"🎵 **Now Playing**\n\n**Title:** [{media.title}]({media.url})\n**Duration:** {media.duration}\n**Requested by:** {media.user}"
+                preloader.schedule(chat_id)
+                text = self.caption(media, tier)
                 keyboard = buttons.controls(chat_id)
                 try:
-                    await message.edit_media(media=types.InputMediaPhoto(media=_thumb, caption=text), reply_markup=keyboard)
+                    await utils.send_photo(_thumb, lambda photo: message.edit_media(media=types.InputMediaPhoto(media=photo, caption=text), reply_markup=keyboard))
                 except MessageIdInvalid:
-                    new_msg = await app.send_photo(chat_id=chat_id, photo=_thumb, caption=text, reply_markup=keyboard)
+                    new_msg = await utils.send_photo(_thumb, lambda photo: app.send_photo(chat_id=chat_id, photo=photo, caption=text, reply_markup=keyboard))
                     media.message_id = new_msg.id
         except FileNotFoundError:
             await message.edit_text(f"File not found. Please contact {config.SUPPORT_CHAT}")
@@ -933,6 +2344,25 @@ class TgCall(PyTgCalls):
             await self.stop(chat_id)
             await message.edit_text("Telegram server error.")
 
+    async def seek(self, chat_id: int, message: types.Message, position: int) -> int | None:
+        # Returns the new position, 0 when it is past the end of the track, or None when
+        # the seek failed and the message already says why.
+        media = queue.get_current(chat_id)
+        if not media or not media.file_path:
+            await message.edit_text("Nothing is playing right now.")
+            return None
+        if media.duration_sec and position >= media.duration_sec:
+            return 0
+
+        position = max(1, position)
+        await self.play_media(chat_id, message, media, seek_time=position)
+        # play_media handles its own errors, possibly by stopping the call or moving on.
+        if not await db.get_call(chat_id) or queue.get_current(chat_id) is not media:
+            return None
+        media.time = position
+        await db.playing(chat_id, paused=False)
+        return position
+
     async def replay(self, chat_id: int) -> None:
         if not await db.get_call(chat_id):
             return
@@ -946,6 +2376,19 @@ class TgCall(PyTgCalls):
             return
 
         media = queue.get_next(chat_id)
+        if media and (prepared := preloader.take(chat_id, media)):
+            client = await db.get_assistant(chat_id)
+            try:
+                await client.play(chat_id=chat_id, stream=prepared["stream"], config=GroupCallConfig(auto_start=False))
+            except Exception as e:
+                logger.warning(f"Prepared stream failed in {chat_id}, falling back: {e}")
+            else:
+                media.time = 1
+                governor.track(chat_id, prepared["tier"])
+                preloader.schedule(chat_id)
+                asyncio.create_task(self.announce(chat_id, media, prepared))
+                return
+
         try:
             if media and media.message_id:
                 await app.delete_messages(chat_id=chat_id, message_ids=media.message_id, revoke=True)
@@ -975,19 +2418,620 @@ class TgCall(PyTgCalls):
         async def update_handler(_, update: Update) -> None:
             if isinstance(update, StreamEnded):
                 if update.stream_type == StreamEnded.Type.AUDIO:
-                    await self.play_next(update.chat_id)
+                    await controller.submit(update.chat_id, "end", queue.get_current(update.chat_id))
             elif isinstance(update, ChatUpdate):
                 if update.status in [ChatUpdate.Status.KICKED, ChatUpdate.Status.LEFT_GROUP, ChatUpdate.Status.CLOSED_VOICE_CHAT]:
-                    await self.stop(update.chat_id)
+                    await controller.submit(update.chat_id, "stop")
+            elif isinstance(update, UpdatedGroupCallParticipant):
+                audience.update(update.chat_id, update.participant)
 
     async def boot(self) -> None:
         for ub in userbot.clients:
             client = PyTgCalls(ub, cache_duration=100)
             await client.start()
             self.clients.append(client)
+            self.assistants[ub.num] = client
             await self.decorators(client)
         logger.info("PyTgCalls client(s) started.")
 
+class Admission:
+    def __init__(self):
+        self.calls = {}
+        self.waitlist = deque()
+
+    def load(self, num: int | None = None) -> int:
+        return sum(w for n, w in self.calls.values() if num is None or n == num)
+
+    def fits(self, num: int, weight: int) -> bool:
+        if config.MAX_CALLS and self.load() + weight > config.MAX_CALLS:
+            return False
+        if config.MAX_ASSISTANT_CALLS and self.load(num) + weight > config.MAX_ASSISTANT_CALLS:
+            return False
+        return True
+
+    def position(self, chat_id: int) -> int:
+        for i, entry in enumerate(self.waitlist, start=1):
+            if entry["chat_id"] == chat_id:
+                return i
+        return 0
+
+    async def admit(self, chat_id: int, video: bool) -> bool:
+        if chat_id in self.calls:
+            return True
+        await db.get_assistant(chat_id)
+        num = db.assistant[chat_id]
+        weight = config.VIDEO_WEIGHT if video else 1
+        if not self.fits(num, weight):
+            return False
+        self.calls[chat_id] = (num, weight)
+        return True
+
+    def wait(self, chat_id: int, message: types.Message, media: Media | Track) -> int:
+        if not (position := self.position(chat_id)):
+            self.waitlist.append({"chat_id": chat_id, "message": message, "media": media})
+            position = len(self.waitlist)
+        return position
+
+    def release(self, chat_id: int) -> None:
+        self.waitlist = deque(e for e in self.waitlist if e["chat_id"] != chat_id)
+        if self.calls.pop(chat_id, None) and self.waitlist:
+            asyncio.create_task(self.drain())
+
+    async def drain(self) -> None:
+        started = []
+        # Walk in arrival order; a waiter that does not fit does not block lighter
+        # requests or ones placed on another assistant.
+        for entry in list(self.waitlist):
+            if await self.admit(entry["chat_id"], entry["media"].video):
+                self.waitlist.remove(entry)
+                started.append(entry)
+
+        for entry in started:
+            asyncio.create_task(self.start(entry))
+        if started:
+            for i, entry in enumerate(self.waitlist, start=1):
+                try:
+                    await entry["message"].edit_text(f"All voice chats are busy. You are #{i} in the waitlist.")
+                except:
+                    pass
+
+    async def start(self, entry: dict) -> None:
+        chat_id, message, media = entry["chat_id"], entry["message"], entry["media"]
+        if queue.get_current(chat_id) is not media:
+            return self.release(chat_id)
+        try:
+            await message.edit_text("Capacity freed up, starting your request...")
+            if not media.file_path:
+                media.file_path = await yt.download(media.id, video=media.video)
+            await controller.submit(chat_id, "start", message, media)
+        except Exception as e:
+            logger.warning(f"Failed to start waitlisted request in {chat_id}: {e}")
+            await controller.submit(chat_id, "stop")
+
+class Audience:
+    def __init__(self):
+        self.listeners = {}
+        self.timers = {}
+        self.clients = {}
+        self.unseeded = set()
+
+    def assistant_id(self, chat_id: int) -> int:
+        return userbot.assistants[db.assistant.get(chat_id, 1)].id
+
+    def watch(self, chat_id: int, client: PyTgCalls) -> None:
+        if config.AUTO_END and chat_id not in self.listeners:
+            self.listeners[chat_id] = set()
+            self.clients[chat_id] = client
+            asyncio.create_task(self.seed(chat_id, client))
+
+    async def seed(self, chat_id: int, client: PyTgCalls) -> None:
+        try:
+            participants = await client.get_participants(chat_id)
+        except Exception as e:
+            # Without a baseline an empty set means nothing, so never start the timer
+            # from it; the next participant update retries the lookup.
+            logger.warning(f"Failed to fetch participants in {chat_id}: {e}")
+            if chat_id in self.listeners:
+                self.unseeded.add(chat_id)
+            return
+        if chat_id not in self.listeners:
+            return
+        self.unseeded.discard(chat_id)
+        self.listeners[chat_id].update(p.user_id for p in participants)
+        self.check(chat_id)
+
+    def update(self, chat_id: int, participant: GroupCallParticipant) -> None:
+        if chat_id not in self.listeners:
+            return
+        if participant.action == GroupCallParticipant.Action.LEFT:
+            self.listeners[chat_id].discard(participant.user_id)
+        else:
+            self.listeners[chat_id].add(participant.user_id)
+        if chat_id in self.unseeded:
+            asyncio.create_task(self.seed(chat_id, self.clients[chat_id]))
+            return
+        self.check(chat_id)
+
+    def check(self, chat_id: int) -> None:
+        alone = not (self.listeners[chat_id] - {self.assistant_id(chat_id)})
+        if alone and chat_id not in self.timers:
+            self.timers[chat_id] = asyncio.create_task(self.end(chat_id))
+        elif not alone and chat_id in self.timers:
+            self.timers.pop(chat_id).cancel()
+
+    async def end(self, chat_id: int) -> None:
+        await asyncio.sleep(config.AUTO_END_TIME)
+        self.timers.pop(chat_id, None)
+        if not await db.get_call(chat_id):
+            return
+        logger.info(f"Auto end: no listeners in {chat_id}, stopping stream.")
+        await controller.submit(chat_id, "stop")
+        try:
+            await app.send_message(chat_id, "Stream ended as no one was listening in the voice chat.")
+        except:
+            pass
+
+    def clear(self, chat_id: int) -> None:
+        self.listeners.pop(chat_id, None)
+        self.clients.pop(chat_id, None)
+        self.unseeded.discard(chat_id)
+        if timer := self.timers.pop(chat_id, None):
+            timer.cancel()
+
+class Reaper:
+    def __init__(self):
+        self.activity = {}
+        self.heap = []
+        self.members = defaultdict(set)
+
+    def touch(self, num: int, chat_id: int) -> None:
+        now = time.time()
+        self.activity[(num, chat_id)] = now
+        self.members[num].add(chat_id)
+        # Superseded entries stay in the heap and are skipped when popped.
+        if config.AUTO_LEAVE:
+            heapq.heappush(self.heap, (now + config.AUTO_LEAVE_TIME, num, chat_id))
+
+    async def join(self, chat_id: int) -> str | None:
+        num = db.assistant[chat_id]
+        if chat_id in self.members[num] or not userbot.clients:
+            return None
+        client = userbot.assistants[num]
+        try:
+            member = await app.get_chat_member(chat_id, client.id)
+            if member.status == enums.ChatMemberStatus.BANNED:
+                return f"Assistant is banned in this chat. Unban {client.mention} and try again."
+        except UserNotParticipant:
+            try:
+                chat = await app.get_chat(chat_id)
+                # A one-time link leaves the group's primary invite link untouched.
+                link = chat.username or (await app.create_chat_invite_link(chat_id, member_limit=1)).invite_link
+                await client.join_chat(link)
+            except UserAlreadyParticipant:
+                pass
+            except ChatAdminRequired:
+                return "I need permission to invite users so the assistant can join."
+            except InviteRequestSent:
+                return f"Assistant sent a join request. Approve {client.mention} and try again."
+            except RPCError as e:
+                logger.warning(f"Assistant {num} failed to join {chat_id}: {e}")
+                return f"Assistant failed to join this chat: {type(e).__name__}"
+        self.members[num].add(chat_id)
+        return None
+
+    async def leave(self, num: int, chat_id: int) -> None:
+        try:
+            await userbot.assistants[num].leave_chat(chat_id)
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+            heapq.heappush(self.heap, (time.time(), num, chat_id))
+            return
+        except Exception as e:
+            logger.warning(f"Assistant {num} failed to leave {chat_id}: {e}")
+        self.activity.pop((num, chat_id), None)
+        self.members[num].discard(chat_id)
+
+    async def load(self) -> None:
+        for num, client in userbot.assistants.items():
+            async for dialog in client.get_dialogs():
+                if dialog.chat.type in (enums.ChatType.GROUP, enums.ChatType.SUPERGROUP):
+                    self.touch(num, dialog.chat.id)
+        logger.info(f"Auto leave tracking {len(self.activity)} assistant chats.")
+
+    async def run(self):
+        await self.load()
+        while True:
+            now = time.time()
+            batch = []
+            while self.heap and self.heap[0][0] <= now and len(batch) < config.AUTO_LEAVE_BATCH:
+                _, num, chat_id = heapq.heappop(self.heap)
+                last = self.activity.get((num, chat_id))
+                if last is None or last + config.AUTO_LEAVE_TIME > now or chat_id == config.LOGGER_ID:
+                    continue
+                if await db.get_call(chat_id):
+                    self.touch(num, chat_id)
+                    continue
+                batch.append((num, chat_id))
+
+            for num, chat_id in batch:
+                await self.leave(num, chat_id)
+                await asyncio.sleep(2)
+            if batch:
+                logger.info(f"Auto leave: assistants left {len(batch)} idle chats.")
+                await asyncio.sleep(30)
+                continue
+
+            delay = self.heap[0][0] - time.time() if self.heap else config.AUTO_LEAVE_TIME
+            await asyncio.sleep(max(delay, 1))
+
+class Preloader:
+    def __init__(self):
+        self.prepared = {}
+        self.tasks = {}
+
+    def schedule(self, chat_id: int) -> None:
+        self.clear(chat_id)
+        self.tasks[chat_id] = asyncio.create_task(self.prepare(chat_id))
+
+    def clear(self, chat_id: int) -> None:
+        self.prepared.pop(chat_id, None)
+        task = self.tasks.pop(chat_id, None)
+        if task and not task.done():
+            task.cancel()
+
+    def take(self, chat_id: int, media: Media | Track) -> dict | None:
+        prepared = self.prepared.pop(chat_id, None)
+        return prepared if prepared and prepared["media"] is media else None
+
+    async def prepare(self, chat_id: int) -> None:
+        # Download, render and build the next item while the current one plays,
+        # so the switch on StreamEnded is a single client.play call.
+        media = queue.get_next(chat_id, check=True)
+        if not media:
+            return
+        try:
+            if not media.file_path:
+                media.file_path = await yt.download(media.id, video=media.video)
+                if not media.file_path:
+                    return
+            _thumb = await thumb.generate(media) if isinstance(media, Track) else config.DEFAULT_THUMB
+            tier = governor.pick()
+            self.prepared[chat_id] = {
+                "media": media,
+                "stream": anon.build_stream(media, 0, tier),
+                "thumb": _thumb,
+                "tier": tier,
+                "text": anon.caption(media, tier),
+            }
+        except Exception as e:
+            logger.warning(f"Failed to prepare next track in {chat_id}: {e}")
+
+class Controller:
+    def __init__(self):
+        self.pending = defaultdict(list)
+        self.workers = {}
+
+    async def submit(self, chat_id: int, action: str, *args):
+        ops = self.pending[chat_id]
+        if action == "skip" and ops and ops[-1]["action"] == "skip":
+            # Taps that arrive while a skip is still queued collapse into one jump.
+            ops[-1]["count"] += 1
+            future = ops[-1]["future"]
+        else:
+            if action == "stop":
+                for op in ops:
+                    op["future"].set_result(None)
+                ops.clear()
+            future = asyncio.get_running_loop().create_future()
+            ops.append({"action": action, "args": args, "count": 1, "future": future})
+
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.run(chat_id))
+        return await asyncio.shield(future)
+
+    async def execute(self, chat_id: int, action: str, args: tuple, count: int):
+        if action == "skip":
+            for _ in range(count - 1):
+                queue.remove_current(chat_id)
+            return await anon.play_next(chat_id)
+        if action == "end":
+            # Ignore end events for a track that a skip or stop has already replaced.
+            if queue.get_current(chat_id) is args[0]:
+                return await anon.play_next(chat_id)
+            return None
+        if action == "start":
+            # A waitlisted request may have been skipped or stopped while it downloaded.
+            message, media = args
+            if queue.get_current(chat_id) is not media:
+                return admission.release(chat_id)
+            return await anon.play_media(chat_id, message, media)
+        return await getattr(anon, action)(chat_id, *args)
+
+    async def run(self, chat_id: int):
+        ops = self.pending[chat_id]
+        try:
+            while ops:
+                op = ops.pop(0)
+                try:
+                    result = await self.execute(chat_id, op["action"], op["args"], op["count"])
+                    if not op["future"].done():
+                        op["future"].set_result(result)
+                except Exception as e:
+                    logger.warning(f"Failed to {op['action']} in {chat_id}: {e}")
+                    if not op["future"].done():
+                        op["future"].set_result(None)
+        finally:
+            self.workers.pop(chat_id, None)
+            if not ops:
+                self.pending.pop(chat_id, None)
+
+# ==================== BROADCAST ====================
+class Broadcast:
+    def __init__(self):
+        self.task = None
+        self.state = None
+        self.rate = config.BROADCAST_RATE
+        self.last_status = 0.0
+        # PeerIdInvalid and ChannelPrivate often just mean this session has not met the
+        # peer yet (fresh or worker sessions), so they count as failures, not dead peers.
+        self.dead = (UserIsBlocked, InputUserDeactivated, ChatWriteForbidden)
+
+    @property
+    def running(self) -> bool:
+        return bool(self.task and not self.task.done())
+
+    async def checkpoint(self) -> None:
+        await db.cache.update_one({"_id": "broadcast"}, {"$set": self.state}, upsert=True)
+
+    async def start(self, from_chat: int, message_id: int, mode: str, phases: list[str], status: types.Message) -> None:
+        self.state = {
+            "from_chat": from_chat,
+            "message_id": message_id,
+            "mode": mode,
+            "phases": phases,
+            "phase": 0,
+            "last_id": None,
+            "sent": 0,
+            "failed": 0,
+            "pruned": 0,
+            "started": time.time(),
+            "status_chat": status.chat.id,
+            "status_id": status.id,
+            "done": False,
+        }
+        await self.checkpoint()
+        self.task = asyncio.create_task(self.run())
+
+    async def resume(self) -> None:
+        doc = await db.cache.find_one({"_id": "broadcast"})
+        if doc and not doc.get("done"):
+            doc.pop("_id")
+            self.state = doc
+            logger.info(f"Resuming broadcast after {doc['sent']} messages.")
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.running:
+            self.task.cancel()
+        if self.state:
+            self.state["done"] = True
+            await self.checkpoint()
+
+    def report(self) -> str:
+        state = self.state
+        elapsed = max(time.time() - state["started"], 1)
+        total = len(db.users) * ("users" in state["phases"]) + len(db.chats) * ("chats" in state["phases"])
+        done = state["sent"] + state["failed"] + state["pruned"]
+        speed = state["sent"] / elapsed
+        eta = utils.format_eta(int(max(total - done, 0) / speed)) if speed else "N/A"
+        return (
+            f"📣 **Broadcast {'finished' if state['done'] else 'in progress'}**\n\n"
+            f"**Sent:** {state['sent']}\n**Failed:** {state['failed']}\n**Pruned:** {state['pruned']}\n"
+            f"**Throughput:** {speed:.1f} msg/s (limit {self.rate}/s)\n**Elapsed:** {utils.format_eta(int(elapsed))}\n**ETA:** {eta}"
+        )
+
+    async def send_status(self, force: bool = False) -> None:
+        if not force and time.time() - self.last_status < 10:
+            return
+        self.last_status = time.time()
+        try:
+            await app.edit_message_text(self.state["status_chat"], self.state["status_id"], self.report())
+        except Exception:
+            pass
+
+    async def send(self, chat_id: int, users: bool) -> int:
+        try:
+            if self.state["mode"] == "forward":
+                await app.forward_messages(chat_id, self.state["from_chat"], self.state["message_id"])
+            else:
+                await app.copy_message(chat_id, self.state["from_chat"], self.state["message_id"])
+            self.state["sent"] += 1
+        except FloodWait as e:
+            return e.value
+        except self.dead:
+            await (db.rm_user(chat_id) if users else db.rm_chat(chat_id))
+            self.state["pruned"] += 1
+        except Exception:
+            self.state["failed"] += 1
+        return 0
+
+    async def run(self):
+        state = self.state
+        while state["phase"] < len(state["phases"]):
+            users = state["phases"][state["phase"]] == "users"
+            collection = db.usersdb if users else db.chatsdb
+            query = {"_id": {"$gt": state["last_id"]}} if state["last_id"] is not None else {}
+            page = [doc["_id"] async for doc in collection.find(query).sort("_id", 1).limit(1000)]
+            if not page:
+                state["phase"] += 1
+                state["last_id"] = None
+                await self.checkpoint()
+                continue
+
+            while page:
+                # One batch per second at the current rate; FloodWait halves the rate and retries the batch's
+                # throttled sends, a clean second nudges it back up towards BROADCAST_RATE.
+                batch, page = page[:self.rate], page[self.rate:]
+                last_id = batch[-1]
+                while batch:
+                    start = time.monotonic()
+                    waits = await asyncio.gather(*[self.send(chat_id, users) for chat_id in batch])
+                    batch = [chat_id for chat_id, wait in zip(batch, waits) if wait]
+                    if batch:
+                        self.rate = max(1, self.rate // 2)
+                        await asyncio.sleep(max(waits))
+                    else:
+                        self.rate = min(config.BROADCAST_RATE, self.rate + 1)
+                        await asyncio.sleep(max(0.0, 1 - (time.monotonic() - start)))
+                state["last_id"] = last_id
+                await self.checkpoint()
+                await self.send_status()
+        state["done"] = True
+        await self.checkpoint()
+        await self.send_status(force=True)
+
+# ==================== SHARDING ====================
+class Shard:
+    def __init__(self):
+        self.role = config.SHARD_ROLE
+        self.id = config.SHARD_ID
+        self.workers = config.SHARD_WORKERS
+        self.live = set(range(self.workers))
+        self.procs = {}
+        self.sessions = [n for n, session in enumerate((config.SESSION1, config.SESSION2, config.SESSION3), start=1) if session]
+
+    def owner(self, num: int) -> int:
+        return (num - 1) % self.workers
+
+    def owns(self, num: int) -> bool:
+        if self.role == "front":
+            return False
+        if self.role == "worker":
+            return self.owner(num) == self.id
+        return True
+
+    async def matches(self, update: types.Message | types.CallbackQuery) -> bool:
+        handler_type = MessageHandler if isinstance(update, types.Message) else CallbackQueryHandler
+        for group, handlers in app.dispatcher.groups.items():
+            for handler in handlers:
+                if group >= 0 and isinstance(handler, handler_type) and await handler.check(app, update):
+                    return True
+        return False
+
+    async def assign(self, chat_id: int) -> int:
+        nums = [n for n in self.sessions if self.owner(n) in self.live] or self.sessions
+        counts = {n: await db.assistantdb.count_documents({"num": n}) for n in nums}
+        num = min(nums, key=lambda n: (counts[n], random.random()))
+        await db.assistantdb.update_one({"_id": chat_id}, {"$set": {"num": num}}, upsert=True)
+        return num
+
+    async def route(self, chat_id: int) -> int:
+        workers = sorted(self.live or range(self.workers))
+        if chat_id > 0:
+            return workers[chat_id % len(workers)]
+
+        # A chat stays on the worker running its call until the call ends. A call on a
+        # dead worker is gone with it, so its pin is dropped rather than followed.
+        if pin := await db.pinsdb.find_one({"_id": chat_id}):
+            if pin["worker"] in self.live:
+                return pin["worker"]
+            await db.pinsdb.delete_one({"_id": chat_id, "worker": pin["worker"]})
+
+        # Otherwise it goes to whichever worker owns its assistant, and is only moved
+        # to another assistant while that worker is down.
+        doc = await db.assistantdb.find_one({"_id": chat_id})
+        num = doc["num"] if doc else None
+        if num not in self.sessions or self.owner(num) not in self.live:
+            num = await self.assign(chat_id)
+        return self.owner(num)
+
+    async def forward(self, kind: str, chat_id: int, **data) -> None:
+        await db.shardsdb.insert_one({"worker": await self.route(chat_id), "kind": kind, "chat_id": chat_id, "ts": time.time(), **data})
+
+    async def rebuild(self, doc: dict) -> types.Message | types.CallbackQuery:
+        message = await app.get_messages(doc["chat_id"], doc["message_id"])
+        if doc["kind"] == "message":
+            return message
+        return types.CallbackQuery(
+            client=app,
+            id=doc["query_id"],
+            from_user=await app.get_users(doc["user_id"]),
+            chat_instance=doc["chat_instance"],
+            message=message,
+            data=doc["data"],
+        )
+
+    async def dispatch(self, doc: dict) -> None:
+        # The front may have moved an idle chat to another assistant while we were away.
+        if doc["chat_id"] not in db.active_calls:
+            db.assistant.pop(doc["chat_id"], None)
+        try:
+            update = await self.rebuild(doc)
+            handler_type = MessageHandler if doc["kind"] == "message" else CallbackQueryHandler
+            for group in sorted(app.dispatcher.groups):
+                for handler in app.dispatcher.groups[group]:
+                    if isinstance(handler, handler_type) and await handler.check(app, update):
+                        await handler.callback(app, update)
+                        break
+        except StopPropagation:
+            pass
+        except Exception as e:
+            logger.error(f"Shard {self.id} failed to handle {doc['kind']} in {doc['chat_id']}: {e}")
+
+    async def consume(self):
+        await db.shardsdb.create_index([("worker", 1), ("ts", 1)])
+        while True:
+            doc = await db.shardsdb.find_one_and_delete({"worker": self.id}, sort=[("ts", 1)])
+            if not doc:
+                await asyncio.sleep(0.2)
+                continue
+            asyncio.create_task(self.dispatch(doc))
+
+    async def heartbeat(self):
+        # Calls do not survive a restart, so neither do the pins for them.
+        await db.pinsdb.delete_many({"worker": self.id})
+        while True:
+            await db.nodesdb.update_one(
+                {"_id": self.id},
+                {"$set": {"seen": time.time(), "pid": os.getpid(), "calls": len(db.active_calls)}},
+                upsert=True,
+            )
+            await asyncio.sleep(5)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(5)
+            live = {doc["_id"] async for doc in db.nodesdb.find({"seen": {"$gt": time.time() - 20}}) if doc["_id"] < self.workers}
+            dead, self.live = self.live - live, live
+            for worker in dead:
+                logger.warning(f"Shard worker {worker} is down, rerouting its chats.")
+                async for doc in db.shardsdb.find({"worker": worker}):
+                    await db.shardsdb.update_one({"_id": doc["_id"]}, {"$set": {"worker": await self.route(doc["chat_id"])}})
+
+    async def spawn(self, worker: int):
+        env = {**os.environ, "SHARD_ROLE": "worker", "SHARD_ID": str(worker)}
+        while True:
+            proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            self.procs[worker] = proc
+            code = await proc.wait()
+            logger.warning(f"Shard worker {worker} exited with code {code}, restarting.")
+            await asyncio.sleep(5)
+
+    def start(self) -> None:
+        if self.role == "front":
+            tasks.append(asyncio.create_task(self.watch()))
+            if config.SHARD_SPAWN:
+                for worker in range(self.workers):
+                    tasks.append(asyncio.create_task(self.spawn(worker)))
+        elif self.role == "worker":
+            tasks.append(asyncio.create_task(self.heartbeat()))
+            tasks.append(asyncio.create_task(self.consume()))
+
+    def exit(self) -> None:
+        for proc in self.procs.values():
+            if proc.returncode is None:
+                proc.terminate()
+
 # ==================== LANGUAGE SYSTEM ====================
 class Language:
     def __init__(self):
@@ -1002,7 +3046,7 @@ class Language:
                 "source": "Source Code",
                 "language": "Language",
                 "pinging": "Pinging...",
-                "ping_pong": "**Pong!**\n\n**Latency:** {}ms\n**Uptime:** {}\n**CPU:** {}%\n**RAM:** {}%\n**Disk:** {}%\n**VC Ping:** {}ms",
+                "ping_pong": "**Pong!**\n\n**Latency:** {}ms\n**Uptime:** {}\n**CPU:** {}%\n**RAM:** {}%\n**Disk:** {}%\n**VC Ping:** {}ms\n**Stream Quality:** {}",
                 "not_playing": "Nothing is playing right now.",
                 "play_searching": "Searching...",
                 "play_queued": "**Added to queue**\n\n**Position:** {}\n**Title:** [{}]({})\n**Duration:** {}\n**Requested by:** {}",
@@ -1018,7 +3062,7 @@ class Language:
                 "source": "सोर्स कोड",
                 "language": "भाषा",
                 "pinging": "पिंग कर रहा हूं...",
-                "ping_pong": "**पोंग!**\n\n**लेटेंसी:** {}ms\n**अपटाइम:** {}\n**CPU:** {}%\n**RAM:** {}%\n**डिस्क:** {}%\n**VC पिंग:** {}ms",
+                "ping_pong": "**पोंग!**\n\n**लेटेंसी:** {}ms\n**अपटाइम:** {}\n**CPU:** {}%\n**RAM:** {}%\n**डिस्क:** {}%\n**VC पिंग:** {}ms\n**स्ट्रीम क्वालिटी:** {}",
                 "not_playing": "अभी कुछ नहीं चल रहा है।",
                 "play_searching": "खोज रहा हूं...",
                 "play_queued": "**कतार में जोड़ा गया**\n\n**पोजीशन:** {}\n**टाइटल:** [{}]({})\n**अवधि:** {}\n**द्वारा अनुरोध:** {}",
@@ -1026,13 +3070,16 @@ class Language:
             }
         }
 
-    def language(self, func):
-        @wraps(func)
-        async def wrapper(_, m: types.Message, *args, **kwargs):
-            lang_code = await db.get_lang(m.chat.id)
-            m.lang = self.languages.get(lang_code, self.languages["en"])
-            return await func(_, m, *args, **kwargs)
-        return wrapper
+    def language(self):
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(_, m: types.Message | types.CallbackQuery, *args, **kwargs):
+                chat_id = m.chat.id if isinstance(m, types.Message) else m.message.chat.id
+                lang_code = await db.get_lang(chat_id)
+                m.lang = self.languages.get(lang_code, self.languages["en"])
+                return await func(_, m, *args, **kwargs)
+            return wrapper
+        return decorator
 
     async def get_lang(self, chat_id: int) -> dict:
         lang_code = await db.get_lang(chat_id)
@@ -1041,6 +3088,47 @@ class Language:
     def get_languages(self) -> dict:
         return {"en": "English", "hi": "Hindi"}
 
+# ==================== RATE LIMITING ====================
+class RateLimiter:
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.window = config.RATE_WINDOW
+        self.budgets = {"user": config.RATE_USER, "chat": config.RATE_CHAT, "global": config.RATE_GLOBAL}
+        self.buckets = OrderedDict()
+
+    def bucket(self, key: tuple, now: float) -> list:
+        capacity = self.budgets[key[0]]
+        bucket = self.buckets.get(key)
+        if bucket is None or now - bucket[1] >= self.window:
+            # Idle buckets are full again, so an expired entry is the same as a fresh one.
+            bucket = [float(capacity), now, False]
+            self.buckets[key] = bucket
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / self.window)
+            bucket[1] = now
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+        return bucket
+
+    def take(self, user_id: int, chat_id: int) -> tuple[float, bool]:
+        now = time.time()
+        keys = [("user", user_id), ("chat", chat_id), ("global", 0)]
+        buckets = {key: self.bucket(key, now) for key in keys if self.budgets[key[0]] > 0}
+        empty = [(b, (1 - b[0]) * self.window / self.budgets[k[0]]) for k, b in buckets.items() if b[0] < 1]
+        if not empty:
+            for b in buckets.values():
+                b[0] -= 1
+                b[2] = False
+            return 0.0, False
+
+        # Only the first rejection from an exhausted bucket gets a reply.
+        wait = max(w for _, w in empty)
+        notify = not any(b[2] for b, _ in empty)
+        for b, _ in empty:
+            b[2] = True
+        return wait, notify
+
 # ==================== DECORATORS ====================
 def admin_check(func):
     @wraps(func)
@@ -1064,6 +3152,26 @@ def admin_check(func):
         return await func(_, update, *args, **kwargs)
     return wrapper
 
+def rate_limit(func):
+    @wraps(func)
+    async def wrapper(_, update: types.Message | types.CallbackQuery, *args, **kwargs):
+        chat_id = update.chat.id if isinstance(update, types.Message) else update.message.chat.id
+        user_id = update.from_user.id if update.from_user else 0
+
+        if user_id in app.sudoers:
+            return await func(_, update, *args, **kwargs)
+
+        wait, notify = limiter.take(user_id, chat_id)
+        if not wait:
+            return await func(_, update, *args, **kwargs)
+
+        text = f"Slow down! Try again in {math.ceil(wait)}s."
+        if isinstance(update, types.CallbackQuery):
+            return await update.answer(text if notify else None, show_alert=notify)
+        if notify:
+            return await update.reply_text(text)
+    return wrapper
+
 def can_manage_vc(func):
     @wraps(func)
     async def wrapper(_, update: types.Message | types.CallbackQuery, *args, **kwargs):
@@ -1093,16 +3201,58 @@ db = MongoDB()
 queue = Queue()
 buttons = Inline()
 utils = Utilities()
+digest = LogDigest()
+store = MediaStore()
 thumb = Thumbnail()
+cookies = CookiePool()
+index = SearchIndex()
+popularity = Popularity()
+router = SearchRouter()
 yt = YouTube()
+spotify = Spotify()
+extractor = Extractor()
 tg = Telegram()
+inline = InlineSearch()
+transcoder = Transcoder()
+watchdog = Watchdog()
+governor = Governor()
 anon = TgCall()
 lang = Language()
+shard = Shard()
+controller = Controller()
+admission = Admission()
+limiter = RateLimiter()
+reaper = Reaper()
+audience = Audience()
+preloader = Preloader()
+broadcast = Broadcast()
 
 tasks = []
 boot = time.time()
 
 # ==================== HANDLERS ====================
+@app.on_message(group=-1)
+async def shard_message_handler(_, message: types.Message):
+    if shard.role != "front" or not message.chat or not await shard.matches(message):
+        return
+    await shard.forward("message", message.chat.id, message_id=message.id)
+    message.stop_propagation()
+
+@app.on_callback_query(group=-1)
+async def shard_callback_handler(_, query: types.CallbackQuery):
+    if shard.role != "front" or not query.message or not await shard.matches(query):
+        return
+    await shard.forward(
+        "callback",
+        query.message.chat.id,
+        message_id=query.message.id,
+        query_id=query.id,
+        user_id=query.from_user.id,
+        chat_instance=query.chat_instance,
+        data=query.data,
+    )
+    query.stop_propagation()
+
 @app.on_message(filters.command(["start"]))
 @lang.language()
 async def start_handler(_, message: types.Message):
@@ -1113,7 +3263,7 @@ async def start_handler(_, message: types.Message):
     _text = message.lang["start_pm"].format(message.from_user.first_name, app.name) if private else message.lang["start_gp"].format(app.name)
 
     key = buttons.start_key(message.lang, private)
-    await message.reply_photo(photo=config.START_IMG, caption=_text, reply_markup=key, quote=not private)
+    await utils.send_photo(config.START_IMG, lambda photo: message.reply_photo(photo=photo, caption=_text, reply_markup=key, quote=not private))
 
     if private:
         if not await db.is_user(message.from_user.id):
@@ -1126,6 +3276,7 @@ async def start_handler(_, message: types.Message):
 
 @app.on_message(filters.command(["play", "vplay"]) & filters.group)
 @lang.language()
+@rate_limit
 async def play_handler(_, m: types.Message):
     if not m.from_user:
         return await m.reply_text("Invalid user.")
@@ -1143,14 +3294,32 @@ async def play_handler(_, m: types.Message):
     video = m.command[0] == "vplay" and config.VIDEO_PLAY
     url = yt.url(m)
     
-    if url and not yt.valid(url):
+    if url and not yt.valid(url) and not spotify.valid(url):
         return await m.reply_text("Unsupported URL.")
 
+    if url and spotify.valid(url) and not config.SPOTIFY_CLIENT_ID:
+        return await m.reply_text("Spotify links are not enabled on this bot.")
+
     sent = await m.reply_text(m.lang["play_searching"])
     file = None
+    pending = []
 
     if url:
-        if "playlist" in url:
+        if spotify.valid(url):
+            try:
+                pending = await spotify.resolve(url, sent.id, video)
+            except Exception as e:
+                logger.warning(f"Spotify lookup failed for {url}: {e}")
+            # Start with the first track that resolves; the rest keep resolving meanwhile.
+            while pending and not file:
+                try:
+                    file = await pending.pop(0)
+                except Exception as e:
+                    logger.warning(f"Spotify track failed to resolve: {e}")
+                    continue
+                if file and file.duration_sec > config.DURATION_LIMIT:
+                    file = None
+        elif "playlist" in url:
             tracks = await yt.playlist(config.PLAYLIST_LIMIT, m.from_user.mention, url, video)
             if tracks:
                 file = tracks[0]
@@ -1164,22 +3333,34 @@ async def play_handler(_, m: types.Message):
     elif m.reply_to_message and tg.get_media(m.reply_to_message):
         file = await tg.download(m.reply_to_message, sent)
 
-    if not file:
-        return await sent.edit_text("No results found.")
-
-    if file.duration_sec > config.DURATION_LIMIT:
+    if not file or file.duration_sec > config.DURATION_LIMIT:
+        for future in pending:
+            future.cancel()
+        if not file:
+            return await sent.edit_text("No results found.")
         return await sent.edit_text(f"Duration too long. Max: {config.DURATION_LIMIT // 60} minutes")
 
     file.user = m.from_user.mention
     position = queue.add(m.chat.id, file)
+    if pending:
+        asyncio.create_task(spotify.enqueue(m.chat.id, pending, m.from_user.mention))
+    if isinstance(file, Track):
+        popularity.record(file.id)
+    await utils.play_log(m, file.title, file.duration)
 
     if await db.get_call(m.chat.id):
+        if position == 1:
+            preloader.schedule(m.chat.id)
         await sent.edit_text(
             m.lang["play_queued"].format(position, file.url, file.title, file.duration, m.from_user.mention),
             reply_markup=buttons.play_queued(m.chat.id, file.id, m.lang["play_now"])
         )
         return
 
+    if admission.position(m.chat.id) or not await admission.admit(m.chat.id, file.video):
+        waiting = admission.wait(m.chat.id, sent, queue.get_current(m.chat.id))
+        return await sent.edit_text(f"All voice chats are busy. You are #{waiting} in the waitlist.")
+
     if not file.file_path:
         await sent.edit_text("Downloading...")
         file.file_path = await yt.download(file.id, video=video)
@@ -1193,7 +3374,7 @@ async def skip_handler(_, m: types.Message):
     if not await db.get_call(m.chat.id):
         return await m.reply_text(m.lang["not_playing"])
 
-    await anon.play_next(m.chat.id)
+    await controller.submit(m.chat.id, "skip")
     await m.reply_text(f"Skipped by {m.from_user.mention}")
 
 @app.on_message(filters.command(["pause"]) & filters.group)
@@ -1206,7 +3387,7 @@ async def pause_handler(_, m: types.Message):
     if not await db.playing(m.chat.id):
         return await m.reply_text("Already paused.")
 
-    await anon.pause(m.chat.id)
+    await controller.submit(m.chat.id, "pause")
     await m.reply_text(f"Paused by {m.from_user.mention}", reply_markup=buttons.controls(m.chat.id))
 
 @app.on_message(filters.command(["resume"]) & filters.group)
@@ -1219,7 +3400,7 @@ async def resume_handler(_, m: types.Message):
     if await db.playing(m.chat.id):
         return await m.reply_text("Not paused.")
 
-    await anon.resume(m.chat.id)
+    await controller.submit(m.chat.id, "resume")
     await m.reply_text(f"Resumed by {m.from_user.mention}", reply_markup=buttons.controls(m.chat.id))
 
 @app.on_message(filters.command(["end", "stop"]) & filters.group)
@@ -1229,9 +3410,66 @@ async def stop_handler(_, m: types.Message):
     if not await db.get_call(m.chat.id):
         return await m.reply_text(m.lang["not_playing"])
 
-    await anon.stop(m.chat.id)
+    await controller.submit(m.chat.id, "stop")
     await m.reply_text(f"Stopped by {m.from_user.mention}")
 
+@app.on_message(filters.command(["seek", "forward", "rewind"]) & filters.group)
+@lang.language()
+@can_manage_vc
+async def seek_handler(_, m: types.Message):
+    if not await db.get_call(m.chat.id):
+        return await m.reply_text(m.lang["not_playing"])
+
+    command = m.command[0]
+    if len(m.command) < 2 and command == "seek":
+        return await m.reply_text("Usage: /seek 1:30 or /seek 90")
+
+    try:
+        seconds = utils.to_seconds(m.command[1]) if len(m.command) > 1 else 10
+    except ValueError:
+        return await m.reply_text("Invalid time format.")
+
+    media = queue.get_current(m.chat.id)
+    if not media:
+        return await m.reply_text(m.lang["not_playing"])
+    if command == "forward":
+        seconds = media.time + seconds
+    elif command == "rewind":
+        seconds = media.time - seconds
+
+    sent = await m.reply_text("Seeking...")
+    position = await controller.submit(m.chat.id, "seek", sent, seconds)
+    if position is None:
+        return
+    if not position:
+        return await sent.edit_text("Cannot seek beyond the track duration.")
+    await sent.edit_text(f"Seeked to {utils.format_eta(position)} by {m.from_user.mention}")
+
+@app.on_message(filters.command(["broadcast"]) & filters.user(config.OWNER_ID))
+async def broadcast_handler(_, m: types.Message):
+    flags = m.command[1:]
+    if "-stop" in flags:
+        if not broadcast.running:
+            return await m.reply_text("No broadcast is running.")
+        await broadcast.stop()
+        return await m.reply_text(broadcast.report())
+
+    if "-status" in flags:
+        if not broadcast.state:
+            return await m.reply_text("No broadcast has been started.")
+        return await m.reply_text(broadcast.report())
+
+    if not m.reply_to_message:
+        return await m.reply_text("Usage: reply to a message with /broadcast [-forward] [-users | -chats]\nAlso: /broadcast -status, /broadcast -stop")
+
+    if broadcast.running:
+        return await m.reply_text("A broadcast is already running.")
+
+    phases = ["users"] if "-users" in flags else ["chats"] if "-chats" in flags else ["users", "chats"]
+    mode = "forward" if "-forward" in flags else "copy"
+    sent = await m.reply_text("Broadcast started.")
+    await broadcast.start(m.chat.id, m.reply_to_message.id, mode, phases, sent)
+
 @app.on_message(filters.command(["ping", "alive"]))
 @lang.language()
 async def ping_handler(_, m: types.Message):
@@ -1243,23 +3481,26 @@ async def ping_handler(_, m: types.Message):
     uptime_seconds = int(time.time() - boot)
     uptime_str = f"{uptime_seconds // 3600}h {(uptime_seconds % 3600) // 60}m {uptime_seconds % 60}s"
     
-    await sent.edit_media(
-        media=types.InputMediaPhoto(
-            media=config.PING_IMG,
-            caption=m.lang["ping_pong"].format(
-                latency,
-                uptime_str,
-                psutil.cpu_percent(),
-                psutil.virtual_memory().percent,
-                psutil.disk_usage("/").percent,
-                await anon.ping(),
-            )
+    caption = m.lang["ping_pong"].format(
+        latency,
+        uptime_str,
+        psutil.cpu_percent(),
+        psutil.virtual_memory().percent,
+        psutil.disk_usage("/").percent,
+        await anon.ping(),
+        governor.summary(),
+    )
+    await utils.send_photo(
+        config.PING_IMG,
+        lambda photo: sent.edit_media(
+            media=types.InputMediaPhoto(media=photo, caption=caption),
+            reply_markup=buttons.ping_markup("Support"),
         ),
-        reply_markup=buttons.ping_markup("Support")
     )
 
 @app.on_callback_query(filters.regex("controls"))
 @lang.language()
+@rate_limit
 @can_manage_vc
 async def controls_handler(_, query: types.CallbackQuery):
     args = query.data.split()
@@ -1279,19 +3520,36 @@ async def controls_handler(_, query: types.CallbackQuery):
     if action == "pause":
         if not await db.playing(chat_id):
             return await query.answer("Already paused", show_alert=True)
-        await anon.pause(chat_id)
+        await controller.submit(chat_id, "pause")
         await query.edit_message_reply_markup(reply_markup=buttons.controls(chat_id, status="Paused"))
     elif action == "resume":
         if await db.playing(chat_id):
             return await query.answer("Not paused", show_alert=True)
-        await anon.resume(chat_id)
+        await controller.submit(chat_id, "resume")
         await query.edit_message_reply_markup(reply_markup=buttons.controls(chat_id))
     elif action == "skip":
-        await anon.play_next(chat_id)
+        await controller.submit(chat_id, "skip")
         await query.message.delete()
     elif action == "stop":
-        await anon.stop(chat_id)
+        await controller.submit(chat_id, "stop")
         await query.message.delete()
+    elif action in ("forward", "rewind"):
+        media = queue.get_current(chat_id)
+        if not media:
+            return
+        position = media.time + 10 if action == "forward" else media.time - 10
+        # play_media reports errors by editing its message, which a photo caption cannot take.
+        sent = await app.send_message(chat_id, "Seeking...")
+        position = await controller.submit(chat_id, "seek", sent, position)
+        if position is None:
+            return
+        if not position:
+            return await sent.edit_text("Cannot seek beyond the track duration.")
+        await sent.edit_text(f"Seeked to {utils.format_eta(position)} by {query.from_user.mention}")
+
+@app.on_inline_query()
+async def inline_handler(_, query: types.InlineQuery):
+    await inline.answer(query)
 
 @app.on_callback_query(filters.regex("cancel_dl"))
 async def cancel_dl_handler(_, query: types.CallbackQuery):
@@ -1323,15 +3581,23 @@ async def update_timer():
                 except:
                     pass
 
+async def warm_up():
+    await asyncio.to_thread(profiler.warm, [psutil, yt_dlp, youtube_search, Image, ImageDraw, ImageEnhance, ImageFilter, ImageFont, ImageOps])
+    if config.PROFILE_STARTUP:
+        logger.info(profiler.report())
+
 # ==================== MAIN FUNCTION ====================
 async def stop():
     logger.info("Stopping...")
     for task in tasks:
         task.cancel()
+    shard.exit()
+    await digest.flush()
     await app.exit()
     await userbot.exit()
     await db.close()
     logger.info("Stopped.")
+    log_listener.stop()
 
 async def main():
     # Ensure directories
@@ -1339,9 +3605,14 @@ async def main():
     Path("downloads").mkdir(exist_ok=True)
     
     await db.connect()
+    profiler.phase("database")
     await app.boot()
-    await userbot.boot()
-    await anon.boot()
+    profiler.phase("bot client")
+    if shard.role != "front":
+        await userbot.boot()
+        profiler.phase("assistants")
+        await anon.boot()
+        profiler.phase("pytgcalls")
 
     # Load sudoers
     sudoers = await db.get_sudoers()
@@ -1350,14 +3621,41 @@ async def main():
     logger.info(f"Loaded {len(app.sudoers)} sudo users.")
 
     # Start background tasks
-    tasks.append(asyncio.create_task(track_time()))
-    tasks.append(asyncio.create_task(update_timer()))
+    error_handler.loop = asyncio.get_running_loop()
+    tasks.append(asyncio.create_task(digest.run()))
+    if config.LOOP_WATCHDOG:
+        tasks.append(asyncio.create_task(watchdog.monitor()))
+    shard.start()
+    if shard.role != "front":
+        tasks.append(asyncio.create_task(track_time()))
+        tasks.append(asyncio.create_task(update_timer()))
+        tasks.append(asyncio.create_task(governor.monitor()))
+        for _ in range(config.TRANSCODE_WORKERS):
+            tasks.append(asyncio.create_task(transcoder.worker()))
+        if config.COOKIES_URL:
+            tasks.append(asyncio.create_task(cookies.refresh()))
+        tasks.append(asyncio.create_task(popularity.run()))
+        tasks.append(asyncio.create_task(extractor.run()))
+        if config.AUTO_LEAVE:
+            tasks.append(asyncio.create_task(reaper.run()))
+        if shard.role != "worker" or shard.id == 0:
+            await broadcast.resume()
+    tasks.append(asyncio.create_task(warm_up()))
+    profiler.phase("background tasks")
 
     logger.info("Bot started successfully!")
     await idle()
     await stop()
 
+profiler.phase("module setup")
+
 if __name__ == "__main__":
+    if config.UVLOOP:
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            logger.warning("uvloop is not installed, using the default event loop.")
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
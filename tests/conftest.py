@@ -0,0 +1,12 @@
+import os
+import sys
+
+# main.py reads and validates its configuration at import time.
+os.environ.setdefault("API_ID", "12345")
+os.environ.setdefault("API_HASH", "0123456789abcdef0123456789abcdef")
+os.environ.setdefault("BOT_TOKEN", "12345:test")
+os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+os.environ.setdefault("LOGGER_ID", "-1001")
+os.environ.setdefault("OWNER_ID", "1")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
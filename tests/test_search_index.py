@@ -0,0 +1,49 @@
+import pytest
+
+import main
+
+
+TRACKS = [
+    ("b", "Imagine Dragons - Believer", "ImagineDragonsVEVO", "believer"),
+    ("d", "Luis Fonsi - Despacito ft. Daddy Yankee", "LuisFonsiVEVO", "despacito"),
+]
+
+
+@pytest.fixture
+def index():
+    index = main.SearchIndex()
+    for video_id, title, channel, alias in TRACKS:
+        index.tracks[video_id] = {"title": title, "channel": channel, "duration": "3:24", "views": "1B views"}
+        index._index(video_id, f"{title} {channel}")
+        index._index(video_id, alias)
+    return index
+
+
+@pytest.mark.parametrize("query, video_id", [
+    ("believer", "b"),
+    ("Believer", "b"),
+    ("believer imagine dragons", "b"),
+    ("imagine dragons believer official video", "b"),
+    ("despacito", "d"),
+    ("despacito luis fonsi daddy yankee official", "d"),
+])
+def test_lookup_hits(index, query, video_id):
+    assert index.lookup(query)["id"] == video_id
+
+
+@pytest.mark.parametrize("query", [
+    "believer remix",
+    "believer live",
+    "believer cover",
+    "believer 8d",
+    "despacito remix",
+    "never gonna give you up",
+    "",
+])
+def test_lookup_rejects_other_versions(index, query):
+    assert index.lookup(query) is None
+
+
+def test_covers_allows_typos(index):
+    assert index.covers(["imagine", "dragns"], {"imagine", "dragons", "believer"})
+    assert not index.covers(["believer", "remix"], {"imagine", "dragons", "believer"})
@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+
+import pytest
+from aiohttp import web
+
+import main
+
+
+def track(n: int) -> dict:
+    return {"id": f"t{n}", "name": f"Song {n}", "artists": [{"name": "Artist"}, {"name": "Guest"}], "duration_ms": 200_000 + n}
+
+
+class StandIn:
+    def __init__(self, expires_in: int = 3600, playlist_size: int = 250, album_size: int = 70, revoke_after: int = 0):
+        self.expires_in = expires_in
+        self.revoke_after = revoke_after
+        self.playlist_size = playlist_size
+        self.album_size = album_size
+        self.tokens = 0
+        self.valid = set()
+        self.requests = []
+
+    async def token(self, request: web.Request) -> web.Response:
+        assert request.headers["Authorization"].startswith("Basic ")
+        assert (await request.post())["grant_type"] == "client_credentials"
+        self.tokens += 1
+        token = f"token-{self.tokens}"
+        self.valid.add(token)
+        return web.json_response({"access_token": token, "token_type": "Bearer", "expires_in": self.expires_in})
+
+    def check(self, request: web.Request) -> None:
+        self.requests.append(request.path_qs)
+        if len(self.requests) == self.revoke_after:
+            self.valid.clear()
+        if request.headers.get("Authorization", "").removeprefix("Bearer ") not in self.valid:
+            raise web.HTTPUnauthorized()
+
+    def page(self, request: web.Request, total: int, limit: int, wrap: bool) -> web.Response:
+        offset = int(request.query.get("offset", 0))
+        size = min(int(request.query.get("limit", 20)), limit)
+        items = [track(n) for n in range(offset, min(offset + size, total))]
+        nxt = None
+        if offset + size < total:
+            nxt = str(request.url.with_query({**request.query, "offset": offset + size, "limit": size}))
+        return web.json_response({"items": [{"track": t} for t in items] if wrap else items, "next": nxt, "total": total})
+
+    async def tracks(self, request: web.Request) -> web.Response:
+        self.check(request)
+        return web.json_response({"tracks": [track(int(i[1:])) for i in request.query["ids"].split(",")]})
+
+    async def album(self, request: web.Request) -> web.Response:
+        self.check(request)
+        return self.page(request, self.album_size, 50, wrap=False)
+
+    async def playlist(self, request: web.Request) -> web.Response:
+        self.check(request)
+        return self.page(request, self.playlist_size, 100, wrap=True)
+
+
+@contextlib.asynccontextmanager
+async def serve(stand_in: StandIn):
+    app = web.Application()
+    app.router.add_post("/api/token", stand_in.token)
+    app.router.add_get("/v1/tracks", stand_in.tracks)
+    app.router.add_get("/v1/albums/{id}/tracks", stand_in.album)
+    app.router.add_get("/v1/playlists/{id}/tracks", stand_in.playlist)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    urls = main.config.SPOTIFY_API_URL, main.config.SPOTIFY_AUTH_URL
+    main.config.SPOTIFY_API_URL = f"http://{host}:{port}/v1"
+    main.config.SPOTIFY_AUTH_URL = f"http://{host}:{port}/api/token"
+    try:
+        yield
+    finally:
+        main.config.SPOTIFY_API_URL, main.config.SPOTIFY_AUTH_URL = urls
+        await runner.cleanup()
+
+
+@pytest.fixture
+def spotify(monkeypatch):
+    monkeypatch.setattr(main.config, "SPOTIFY_CLIENT_ID", "client")
+    monkeypatch.setattr(main.config, "SPOTIFY_CLIENT_SECRET", "secret")
+    return main.Spotify()
+
+
+def run(stand_in: StandIn, spotify: main.Spotify, url: str, limit: int = 20) -> list[dict]:
+    async def _run():
+        async with serve(stand_in):
+            return await spotify.tracks(url, limit)
+    return asyncio.run(_run())
+
+
+@pytest.mark.parametrize("url", [
+    "https://open.spotify.com/track/t7",
+    "https://open.spotify.com/intl-de/track/t7",
+    "open.spotify.com/track/t7",
+])
+def test_track_link(spotify, url):
+    stand_in = StandIn()
+    assert run(stand_in, spotify, url) == [{"id": "t7", "name": "Song 7", "artists": "Artist, Guest", "duration": 200}]
+    assert stand_in.requests == ["/v1/tracks?ids=t7"]
+
+
+def test_album_pages_of_fifty(spotify):
+    stand_in = StandIn(album_size=70)
+    tracks = run(stand_in, spotify, "https://open.spotify.com/album/a1", limit=100)
+    assert [t["id"] for t in tracks] == [f"t{n}" for n in range(70)]
+    assert len(stand_in.requests) == 2
+    assert all("limit=50" in r for r in stand_in.requests)
+
+
+def test_playlist_pages_of_hundred(spotify):
+    stand_in = StandIn(playlist_size=250)
+    tracks = run(stand_in, spotify, "https://open.spotify.com/playlist/p1", limit=300)
+    assert [t["id"] for t in tracks] == [f"t{n}" for n in range(250)]
+    assert len(stand_in.requests) == 3
+
+
+def test_playlist_stops_at_limit(spotify):
+    stand_in = StandIn(playlist_size=250)
+    tracks = run(stand_in, spotify, "https://open.spotify.com/playlist/p1", limit=20)
+    assert len(tracks) == 20
+    assert len(stand_in.requests) == 1
+
+
+def test_token_is_reused(spotify):
+    stand_in = StandIn(playlist_size=250)
+    run(stand_in, spotify, "https://open.spotify.com/playlist/p1", limit=300)
+    assert stand_in.tokens == 1
+
+
+def test_expired_token_is_refreshed(spotify):
+    # expires_in inside the refresh margin: every request needs a new token.
+    stand_in = StandIn(expires_in=30, playlist_size=250)
+    run(stand_in, spotify, "https://open.spotify.com/playlist/p1", limit=300)
+    assert stand_in.tokens == 3
+
+
+def test_revoked_token_is_refreshed(spotify):
+    stand_in = StandIn(album_size=70, revoke_after=2)
+    tracks = run(stand_in, spotify, "https://open.spotify.com/album/a1", limit=100)
+    assert len(tracks) == 70
+    assert stand_in.tokens == 2
+
+
+def test_rejects_other_links(spotify):
+    assert not spotify.valid("https://open.spotify.com/artist/abc")
+    assert not spotify.valid("https://youtube.com/watch?v=abcdefghijk")